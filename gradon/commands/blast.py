@@ -1,28 +1,69 @@
 """ Process all files in a tree with radon """
 
+import multiprocessing
 import os
+import stat
 
 from .. import stats
 from .. import file_system
 
 import click
 
+MAX_WORKERS = 8
 
-@click.argument('paths', type=click.Path(exists=True, readable=True, resolve_path=True), nargs=-1,
-                required=True)
-@click.pass_context
-def command(ctx, paths):
+
+def _stat_paths(ctx, param, paths):
+    """ Returns (path, is_dir) pairs, using one stat per path to check it exists """
+    result = []
     for path in paths:
-        if os.path.isdir(path):
-            dest = path
-            files = None
-        else:
-            dest = os.path.dirname(path)
-            files = [os.path.basename(path)]
-        dest_fs = file_system.StatsFileSystem(dest)
-        updater = stats.StatsUpdater(path, dest_fs,
-                                     debug=ctx.obj['debug'],
-                                     test_patterns=ctx.obj['test_patterns'],
-                                     parallel=ctx.obj['parallel'])
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            raise click.BadParameter('{}: {}'.format(path, e.strerror))
+        result.append((path, stat.S_ISDIR(st.st_mode)))
+    return result
+
+
+def _blast_one(path, is_dir, debug=False, test_patterns=(), exclude_patterns=(), parallel=False):
+    if is_dir:
+        dest = path
+        files = None
+    else:
+        dest = os.path.dirname(path)
+        files = [os.path.basename(path)]
+    dest_fs = file_system.FileSystem(dest)
+    with stats.StatsUpdater(path, dest_fs,
+                            debug=debug,
+                            test_patterns=test_patterns,
+                            parallel=parallel) as updater:
         updater.update(changed_files=files,
-                       ignore_patterns=ctx.obj['exclude_pattern'])
+                       ignore_patterns=exclude_patterns)
+
+
+def _blast_one_star(args):
+    return _blast_one(*args)
+
+
+@click.argument('paths', type=click.Path(resolve_path=True), nargs=-1, required=True,
+                callback=_stat_paths)
+@click.pass_context
+def command(ctx, paths):
+    if len(paths) == 1:
+        path, is_dir = paths[0]
+        _blast_one(path, is_dir, ctx.obj['debug'], ctx.obj['test_patterns'],
+                   ctx.obj['exclude_patterns'], parallel=ctx.obj['parallel'])
+        return
+
+    # Each path is independent, so analyze them in separate processes.  Workers don't use their
+    # own pools, and the count is capped to limit contention on the disk.
+    pool = multiprocessing.Pool(min(len(paths), multiprocessing.cpu_count(), MAX_WORKERS))
+    try:
+        for _ in pool.imap_unordered(
+                _blast_one_star,
+                [(path, is_dir, ctx.obj['debug'], ctx.obj['test_patterns'],
+                  ctx.obj['exclude_patterns'])
+                 for path, is_dir in paths]):
+            pass
+    finally:
+        pool.close()
+        pool.join()
@@ -1,21 +1,23 @@
-from __future__ import print_function
-
+import csv
 import logging
+import sys
 
 import click
 import tqdm
 
 from .. import core
 from .. import fs_to_csv
-from .. import tools
 
 from . import shared
 
 log = logging.getLogger(__name__)
 
+OUTPUT_BUFFER_SIZE = 1 << 20
+
 
 @shared.git_log_args
-@click.option('--output', '-o', type=click.File(mode='w'), default='-',
+@click.option('--output', '-o', type=click.Path(dir_okay=False, writable=True, allow_dash=True),
+              default='-',
               help="Output destination (default is stdout)")
 @click.option('--force', '-f', is_flag=True, help="Force refresh of cache")
 @click.option('--filter', '-F', 'filters', multiple=True,
@@ -25,8 +27,8 @@ log = logging.getLogger(__name__)
 def command(ctx, rev_range=None, path=None, **options):
     stats_fs = ctx.obj['fs_class'](ctx.obj['cache_dir'], init=options['force'])
 
-    total, source_commits = tools.tee_count(
-        core.generate_shas_for_source_range(ctx.obj['repo'], rev_range))
+    total = core.count_commits_for_source_range(ctx.obj['repo'], rev_range)
+    source_commits = core.generate_shas_for_source_range(ctx.obj['repo'], rev_range)
 
     fs_commits = tqdm.tqdm(
         core.generate_stats_fs_commits_for_source_commits(
@@ -37,6 +39,19 @@ def command(ctx, rev_range=None, path=None, **options):
     filters = options['filters'] or ['^SUBTREE_TOTAL']
     log.info("Generating csv for range '{}'.".format(rev_range) or 'all')
 
-    fs_to_csv.fs_commits_to_csv(
-        stats_fs, fs_commits, options['output'],
-        test_patterns=ctx.obj['test_patterns'], filters=filters)
+    # Rows are streamed one at a time, so give the file a large buffer rather than line buffering
+    if options['output'] == '-':
+        output = sys.stdout
+    else:
+        output = open(options['output'], 'w', OUTPUT_BUFFER_SIZE)
+
+    try:
+        fs_to_csv.fs_commits_to_csv(
+            stats_fs, fs_commits, csv.writer(output),
+            test_patterns=ctx.obj['test_patterns'], filters=filters,
+            parallel=ctx.obj['parallel'])
+    finally:
+        if output is sys.stdout:
+            output.flush()
+        else:
+            output.close()
@@ -1,8 +1,5 @@
-from __future__ import print_function
-
 import logging
-import shutil
-import tempfile
+import os
 
 import click
 
@@ -11,32 +8,46 @@ from . import shared
 
 log = logging.getLogger(__name__)
 
+# Number of diff caches (one per pair of commits and set of patterns) to keep
+DIFF_CACHE_SLOTS = 16
+
 
 @click.argument('first', nargs=1, required=False, metavar='commit')
 @click.argument('last', nargs=1, required=False, metavar='commit')
 @click.option('--all', is_flag=True, help="Show all stats")
 @click.option('--all-grades', is_flag=True, help="Only show grades affecting the score")
+@click.option('--no-cache', is_flag=True,
+              help="Use a throwaway cache instead of the persistent one")
 @click.option('--filter', '-F', 'filters', multiple=True,
               help=('Report only for changes to files matching this artifact. '
                     'Default is to show just stats changes for entire tree'))
 @click.pass_context
 @shared.page_output
 def command(ctx, first=None, last=None, paths=None, **options):
-    cache_path = tempfile.mkdtemp(prefix='gradon-tmp')
     source_repo = ctx.obj['repo']
 
-    try:
+    # Diffs against the working tree can't be reused, so those always get a throwaway cache
+    persistent = last is not None and not options['no_cache']
+    cache_name = None
+    if persistent:
+        cache_name = os.path.join('diff', shared.cache_key(
+            source_repo.git.rev_parse(first or 'HEAD', last), paths,
+            ctx.obj['test_patterns'], ctx.obj['exclude_patterns']))
+
+    with shared.command_cache_path(ctx, cache_name, persistent=persistent,
+                                   keep=DIFF_CACHE_SLOTS) as cache_path:
         stats_fs = ctx.obj['fs_class'](cache_path)
         filters = {'^SUBTREE_TOTAL_TEST': 'TEST CODE', '^SUBTREE_TOTAL_NON_TEST': 'NON-TEST CODE'}
 
-        fs_commit = core.generate_stats_fs_commit_for_diff(
-            stats_fs, source_repo, first, last, paths=paths, **ctx.obj['cache_kwargs'])
+        fs_commits = core.list_stats_fs_commits(stats_fs)
+        if not fs_commits:
+            stats_fs = ctx.obj['fs_class'](cache_path, init=True)
+            fs_commits = [core.generate_stats_fs_commit_for_diff(
+                stats_fs, source_repo, first, last, paths=paths, **ctx.obj['cache_kwargs'])]
 
         stats_iter = core.generate_stats_for_stats_fs_commits(
-            stats_fs, [fs_commit], test_patterns=ctx.obj['test_patterns'],
+            stats_fs, fs_commits, test_patterns=ctx.obj['test_patterns'],
             filters=options['filters'] or filters)
 
         shared.print_stats(stats_iter, source_repo, stats_fs, ctx.obj['cruft_scores'],
                            all=options['all'], name_map=filters, all_grades=options['all_grades'])
-    finally:
-        shutil.rmtree(cache_path)
@@ -1,25 +1,29 @@
+import importlib
 import logging
 
 import click
 import git
 import os
+import re
 import sys
 
-from . import blast
-from . import csv
-from . import diff
-from . import log
-from . import stats
-
 from .. import file_system
+from .. import tools
+
+# Each command lives in the module of the same name in this package
+COMMANDS = ('blast', 'csv', 'diff', 'log', 'stats')
+
+
+class LazyGroup(click.Group):
+    """ Imports a command's module only when that command is needed """
+    def list_commands(self, ctx):
+        return sorted(set(super(LazyGroup, self).list_commands(ctx)) | set(COMMANDS))
 
-COMMANDS = dict(
-    blast=blast.command,
-    csv=csv.command,
-    diff=diff.command,
-    log=log.command,
-    stats=stats.command,
-)
+    def get_command(self, ctx, name):
+        if name in COMMANDS and name not in self.commands:
+            module = importlib.import_module('.' + name, __package__)
+            self.add_command(click.command(name=name)(module.command))
+        return super(LazyGroup, self).get_command(ctx, name)
 
 
 def find_repo(ctx, param, path):
@@ -35,7 +39,14 @@ def create_cruft_score_map(ctx, param, value):
     return {grade: float(score) for grade, score in zip('ABCDEF', value.split(','))}
 
 
-@click.group()
+def compile_patterns(ctx, param, value):
+    try:
+        return tools.compile_patterns(value)
+    except re.error as e:
+        raise click.BadParameter('Invalid regex: {}'.format(e))
+
+
+@click.group(cls=LazyGroup)
 @click.option('-C', 'repo', help="Git repo location", metavar='<path-to-repo>',
               type=click.Path(file_okay=False, resolve_path=True), callback=find_repo)
 @click.option('--debug', '-d', help="Print debug output", count=True)
@@ -48,9 +59,10 @@ def create_cruft_score_map(ctx, param, value):
               callback=create_cruft_score_map,
               help="Comma-separated score values for each grade")
 @click.option('--test-pattern', '-t', 'test_patterns', metavar='REGEX', multiple=True,
-              help="Regex to identify tests",
-              default=[r'^tests?_.*.\py$', r'_tests?\.py$'])
+              help="Regex to identify tests", callback=compile_patterns,
+              default=[r'^tests?_.*\.py$', r'_tests?\.py$'])
 @click.option('--exclude-pattern', '-x', 'exclude_patterns', metavar='REGEX', multiple=True,
+              callback=compile_patterns,
               help="Ignore files whose full path matches these regexps")
 @click.pass_context
 def gradon(ctx, **options):
@@ -72,6 +84,3 @@ def gradon(ctx, **options):
                         level=(logging.DEBUG if options['debug'] > 1 else
                                logging.INFO if options['debug'] == 1 else
                                logging.WARNING))
-
-for name, cmd in COMMANDS.items():
-    gradon.command(name=name)(cmd)
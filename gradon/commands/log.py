@@ -1,21 +1,24 @@
-from __future__ import print_function
-
 import logging
-import shutil
-import tempfile
+import os
 
 import click
 
 from .. import core
+from .. import tools
 from . import shared
 
 log = logging.getLogger(__name__)
 
+# Number of log caches (one per set of patterns and order) to keep
+LOG_CACHE_SLOTS = 4
+
 
 @shared.git_log_args
 @click.option('--all', is_flag=True, help="Show all stats")
 @click.option('--all-grades', is_flag=True, help="Only show grades affecting the score")
 @click.option('--force', '-f', is_flag=True, help="Force refresh of cache")
+@click.option('--no-cache', is_flag=True,
+              help="Use a throwaway cache instead of the persistent one")
 @click.option('--reverse', '-r', is_flag=True, help="Reverse order (default is newest first)")
 @click.option('--filter', '-F', 'filters', multiple=True,
               help=('Report only for changes to files matching this artifact. '
@@ -23,29 +26,35 @@ log = logging.getLogger(__name__)
 @click.pass_context
 @shared.page_output
 def command(ctx, rev_range=None, paths=(), **options):
-    cache_path = tempfile.mkdtemp(prefix='gradon-tmp')
-
     source_repo = ctx.obj['repo']
-    try:
-        stats_fs = ctx.obj['fs_class'](cache_path,
-                                       init=options['force'] or not ctx.obj['cache_dir'])
-        filters = {'^SUBTREE_TOTAL_TEST': 'TEST CODE', '^SUBTREE_TOTAL_NON_TEST': 'NON-TEST CODE'}
+    reverse = (not options['reverse'])  # reversed by default
 
-        reverse = (not options['reverse'])  # reversed by default
+    # Each stats commit only depends on its source commit, so one cache serves every range and
+    # new commits are added to it.  Only the patterns and the processing order change the results.
+    cache_name = os.path.join('log', shared.cache_key(
+        reverse, ctx.obj['test_patterns'], ctx.obj['exclude_patterns']))
+
+    with shared.command_cache_path(ctx, cache_name, persistent=not options['no_cache'],
+                                   keep=LOG_CACHE_SLOTS) as cache_path:
+        stats_fs = ctx.obj['fs_class'](cache_path, init=options['force'])
+        filters = {'^SUBTREE_TOTAL_TEST': 'TEST CODE', '^SUBTREE_TOTAL_NON_TEST': 'NON-TEST CODE'}
 
         source_commits = core.generate_shas_for_source_range(source_repo, rev_range,
                                                              reverse=reverse)
-
-        fs_commits = core.generate_stats_fs_commits_for_source_commits(
-            stats_fs, source_repo, source_commits, reversed=reverse,
-            incremental=True, **ctx.obj['cache_kwargs'])
+        fs_commits = core.generate_cached_stats_fs_commits(
+            stats_fs, source_repo, source_commits, reversed=reverse, **ctx.obj['cache_kwargs'])
 
         stats_iter = core.generate_stats_for_stats_fs_commits(
             stats_fs, fs_commits, test_patterns=ctx.obj['test_patterns'],
             filters=options['filters'] or filters)
 
+        # Generate stats in the background while earlier ones are printed.  Commit objects load
+        # lazily through the stats repo's shared git process, so load them in the same thread.
+        # In parallel the work is already done by worker processes, and the pool must not be
+        # forked from a background thread.
+        if not ctx.obj['parallel']:
+            stats_iter = tools.prefetch(stats_iter, prepare=lambda stats: stats.commit.message)
+
         shared.print_stats(stats_iter, source_repo, stats_fs, ctx.obj['cruft_scores'],
                            all=options['all'], name_map=filters, print_original_commit=True,
                            all_grades=options['all_grades'])
-    finally:
-        shutil.rmtree(cache_path)
@@ -1,27 +1,28 @@
-from __future__ import print_function
-
-try:
-    import contextlib2 as contextlib
-except ImportError:
-    import contextlib
-
 import collections
-import difflib
+import contextlib
 import functools
+import hashlib
 import logging
 import os
 import re
+import shutil
 import subprocess
 import sys
+import tempfile
 import time
-import yaml
-
-import six
 
 import click
 
+from .. import tools
+
 log = logging.getLogger(__name__)
 
+_ORIGINAL_SHA_RE = re.compile(r'\w+')
+
+# Number of parsed .methods.yaml blobs and rendered commit headers to keep while printing stats
+METHOD_CACHE_SIZE = 4096
+HEADER_CACHE_SIZE = 256
+
 
 def parse_rev_range(rev_range, repo):
     if rev_range:
@@ -33,9 +34,8 @@ def parse_rev_range(rev_range, repo):
     else:
         stop_rev = None
         with log_duration('Searching for initial commit...'):
-            # Find the initial commit
-            _, start_rev = max(enumerate(repo.iter_commits()))
-            start_rev = start_rev.hexsha
+            # Find the initial commit (the last root in log order, if there are several)
+            start_rev = repo.git.rev_list('--max-parents=0', 'HEAD').split()[-1]
 
     if stop_rev is None:
         stop_rev = repo.head.commit.hexsha
@@ -82,92 +82,172 @@ def _remove_scoreless_diffs(diffs, cruft_scores):
         yield line
 
 
+def _get_method_list(stats_fs, path, blob_sha, cache):
+    """ Returns the formatted methods in a .methods.yaml blob, memoized in cache """
+    key = (blob_sha, path)
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+
+    module_path = os.path.dirname(path).replace('/', '.')
+    if module_path:
+        module_path += '.'
+
+    methods = []
+    for entry in tools.load_methods(stats_fs.read_blob(blob_sha)):
+        name, value = next(iter(entry.items()))
+        grade, lines = next(iter(value.items()))
+        methods.append('{}{}: {} * {}'.format(module_path, name, grade, lines))
+
+    if len(cache) >= METHOD_CACHE_SIZE:
+        cache.clear()
+    cache[key] = methods
+    return methods
+
+
+def _diff_method_lists(prev, current):
+    """ Returns '- ' lines for methods only in prev and '+ ' lines for those only in current
+
+    Duplicate entries are counted, and lines are ordered by method with removals first.
+    """
+    prev_counts = collections.Counter(prev)
+    current_counts = collections.Counter(current)
+    removed = prev_counts - current_counts
+    added = current_counts - prev_counts
+    changes = sorted([(method, 0) for method in removed.elements()] +
+                     [(method, 1) for method in added.elements()])
+    return ['{} {}'.format('-+'[sign], method) for method, sign in changes]
+
+
+def _get_original_commit(source_repo, sha, cache):
+    """ Returns a source commit and its sorted per-file line stats, memoized in cache """
+    try:
+        return cache[sha]
+    except KeyError:
+        commit = tools.load_commit(source_repo, sha)
+        cache[sha] = (commit, sorted(commit.stats.files.items()))
+        return cache[sha]
+
+
+def _make_grade_scores(cruft_scores):
+    """ Returns (grade, stats key, score) for each grade, for use in the per-row cruft sum """
+    return [(grade, ('grades', grade), cruft_scores[grade]) for grade in 'ABCDEF']
+
+
+def _render_header(s, source_repo, stats_fs, cruft_scores, print_original_commit=False,
+                   all_grades=False, commit_cache=None, method_cache=None):
+    """ Returns the header lines (original commit and method diffs) for a stats commit """
+    if method_cache is None:
+        method_cache = {}
+
+    out = []
+
+    if print_original_commit:
+        original_commit, file_stats = _get_original_commit(
+            source_repo, _ORIGINAL_SHA_RE.match(s.commit.message).group(0),
+            {} if commit_cache is None else commit_cache)
+        out.append('commit {}\nAuthor: {}<{}>\nDate: {}\n{}\n'.format(
+            original_commit.hexsha,
+            original_commit.author,
+            original_commit.author.email,
+            original_commit.committed_datetime,
+            original_commit.message))
+        for filename, data in file_stats:
+            out.append('{} +{} -{}'.format(filename, data['insertions'], data['deletions']))
+        out.append('')
+
+    prev_commit_hexsha = '{}~1'.format(s.commit.hexsha)
+    prev = []
+    current = []
+
+    for change in tools.generate_tree_changes(stats_fs.repo, prev_commit_hexsha,
+                                              s.commit.hexsha):
+        if change.a_path and change.a_path.endswith('.methods.yaml'):
+            log.debug('analyzing previous methods: {}'.format(change.a_path))
+            prev.extend(_get_method_list(stats_fs, change.a_path, change.a_blob,
+                                         method_cache))
+
+        if change.b_path and change.b_path.endswith('.methods.yaml'):
+            log.debug('analyzing current methods: {}'.format(change.b_path))
+            current.extend(_get_method_list(stats_fs, change.b_path, change.b_blob,
+                                            method_cache))
+
+    diffs = _diff_method_lists(prev, current)
+
+    # Remove grade that don't affect scores
+    if not all_grades:
+        diffs = list(_remove_scoreless_diffs(diffs, cruft_scores))
+
+    if all_grades:
+        out.append('METHOD DIFFS:')
+    else:
+        out.append('METHOD DIFFS (affecting score):')
+
+    if diffs:
+        out.append('\n'.join(diffs))
+    else:
+        out.append('  None')
+
+    return out
+
+
 def _print_individual_stats(s, source_repo, stats_fs, cruft_scores, all=False, show_header=False,
-                            name_map=None, print_original_commit=False, all_grades=False):
-    name_map = name_map or {}
-    if show_header:
-        if print_original_commit:
-            original_commit = source_repo.commit(re.match('\w+', s.commit.message).group(0))
-            print('commit {}\nAuthor: {}<{}>\nDate: {}\n{}\n'.format(
-                original_commit.hexsha,
-                original_commit.author,
-                original_commit.author.email,
-                original_commit.committed_datetime,
-                original_commit.message))
-            for filename, data in sorted(
-                source_repo.commit(original_commit).stats.files.items(),
-                    key=lambda pair: pair[0]):
-                print('{} +{} -{}'.format(filename, data['insertions'], data['deletions']))
-            print()
+                            name_map=(), print_original_commit=False, all_grades=False,
+                            commit_cache=None, grade_scores=None, method_cache=None,
+                            header_cache=None):
+    if grade_scores is None:
+        grade_scores = _make_grade_scores(cruft_scores)
+    if header_cache is None:
+        header_cache = {}
 
-        prev_commit_hexsha = '{}~1'.format(s.commit.hexsha)
-        prev = []
-        current = []
-        for diff in s.commit.diff(prev_commit_hexsha):
-            if (diff.b_path and diff.b_path.endswith('.methods.yaml') or
-                    diff.a_path and diff.a_path.endswith('.methods.yaml')):
-
-                def get_method_list(path, sha):
-                    module_path = ''.join(m + '.' for m in os.path.dirname(path).split('/'))
-                    if module_path == '.':
-                        module_path = ''
-                    methods = []
-                    for entry in yaml.safe_load(stats_fs.repo.git.show('{}:{}'.format(sha, path))):
-                        name, value = next(six.iteritems(entry))
-                        grade, lines = next(six.iteritems(value))
-                        methods.append('{module}{name}: {grade} * {lines}'.format(
-                            module=module_path, name=name, grade=grade, lines=lines))
-                    return methods
-
-                log.debug('analyzing deleted:{}, new:{}, a:{}, b:{}'.format(
-                    diff.deleted_file, diff.new_file, diff.a_path, diff.b_path))
-
-                if not diff.new_file:  # deleted is an add because we're comparing backwards
-                    current.extend(get_method_list(diff.b_path, s.commit.hexsha))
-
-                if not diff.deleted_file:  # new is a delete because we're comparing backwards
-                    prev.extend(get_method_list(diff.a_path, prev_commit_hexsha))
-
-        def diff_only(diffs):
-            return filter(lambda s: not s.startswith(' ') and not s.startswith('?'), diffs)
-
-        diffs = diff_only(difflib.ndiff(sorted(prev), sorted(current)))
-
-        # Remove grade that don't affect scores
-        if not all_grades:
-            diffs = list(_remove_scoreless_diffs(diffs, cruft_scores))
-
-        if all_grades:
-            print('METHOD DIFFS:')
-        else:
-            print('METHOD DIFFS (affecting score):')
-
-        if diffs:
-            print('\n'.join(diffs))
-        else:
-            print('  None')
+    # Collect the output and write it once, rather than once per line
+    out = []
+
+    if show_header:
+        try:
+            header = header_cache[s.commit.hexsha]
+        except KeyError:
+            header = _render_header(s, source_repo, stats_fs, cruft_scores,
+                                    print_original_commit=print_original_commit,
+                                    all_grades=all_grades, commit_cache=commit_cache,
+                                    method_cache=method_cache)
+            if len(header_cache) >= HEADER_CACHE_SIZE:
+                header_cache.clear()
+            header_cache[s.commit.hexsha] = header
+        out.extend(header)
 
     name = s.filename
-    for pat, value in name_map.items():
-        if re.search(pat, s.filename):
+    for pat, value in name_map:
+        if pat.search(s.filename):
             name = value
+            break
 
-    print('\n{}:'.format(name))
+    out.append('\n{}:'.format(name))
 
     if all:
-        print(s.delta)
+        out.append(str(s.delta))
     else:
         delta_cruft = 0
-        for grade in 'ABCDEF':
-            value = s.delta[('grades', grade)]
+        for grade, key, score in grade_scores:
+            value = s.delta[key]
             if value:
-                print('  {}: {:+.0f}'.format(grade, value))
-            delta_cruft += int(value) * cruft_scores[grade]
-        print('  CRUFT: {:+.0f}'.format(delta_cruft))
+                out.append('  {}: {:+.0f}'.format(grade, value))
+            delta_cruft += int(value) * score
+        out.append('  CRUFT: {:+.0f}'.format(delta_cruft))
+
+    sys.stdout.write('\n'.join(out) + '\n')
 
 
 def print_stats(stats_iter, source_repo, stats_fs, cruft_scores, all=False, name_map=None,
                 print_original_commit=False, all_grades=False):
+    # Compile the name patterns once rather than for every stats row
+    compiled_name_map = [(re.compile(pat), value) for pat, value in (name_map or {}).items()]
+    commit_cache = {}
+    method_cache = {}
+    header_cache = {}
+    grade_scores = _make_grade_scores(cruft_scores)
+
     prev_commit = None
     stats = None
     for stats in stats_iter:
@@ -175,8 +255,10 @@ def print_stats(stats_iter, source_repo, stats_fs, cruft_scores, all=False, name
         if prev_commit and show_header:
             print()
         _print_individual_stats(stats, source_repo, stats_fs, cruft_scores,
-                                all=all, name_map=name_map, show_header=show_header,
-                                print_original_commit=print_original_commit, all_grades=all_grades)
+                                all=all, name_map=compiled_name_map, show_header=show_header,
+                                print_original_commit=print_original_commit, all_grades=all_grades,
+                                commit_cache=commit_cache, grade_scores=grade_scores,
+                                method_cache=method_cache, header_cache=header_cache)
         prev_commit = stats.commit
 
     if stats:
@@ -191,6 +273,65 @@ def log_duration(message, level=logging.DEBUG):
     log.log(level, 'done ({:.1f}s)'.format(time.time() - start_time))
 
 
+def cache_key(*parts):
+    """ Returns a stable digest of parts for naming caches
+
+    Parts may be nested in tuples and lists, and must otherwise have a stable repr.  Compiled
+    regexes are given by their pattern and flags, because their repr is cut short.
+    """
+    return hashlib.sha1(repr(_cache_key_part(parts)).encode('utf-8')).hexdigest()
+
+
+def _cache_key_part(part):
+    if isinstance(part, (tuple, list)):
+        return tuple(_cache_key_part(p) for p in part)
+    if hasattr(part, 'pattern') and hasattr(part, 'flags'):
+        return (part.pattern, part.flags)
+    return part
+
+
+@contextlib.contextmanager
+def command_cache_path(ctx, name, persistent=True, keep=None):
+    """ Yields the stats cache path for a command
+
+    The cache lives next to the main gradon cache (e.g. '.gradon.log') so it is kept between
+    invocations without being nested inside the main cache repo.  If persistent is False a
+    temporary directory is used and removed afterwards.
+
+    name may have a subdirectory for a family of caches (e.g. 'diff/<key>').  If keep is given,
+    only the keep most recently used caches in that subdirectory are kept afterwards.
+    """
+    if persistent:
+        cache_path = '{}.{}'.format(ctx.obj['cache_dir'].rstrip(os.sep), name)
+        yield cache_path
+        if keep is not None:
+            _prune_caches(os.path.dirname(cache_path), cache_path, keep)
+        return
+
+    cache_path = tempfile.mkdtemp(prefix='gradon-tmp')
+    try:
+        yield cache_path
+    finally:
+        shutil.rmtree(cache_path)
+
+
+def _prune_caches(parent, cache_path, keep):
+    """ Removes all but the keep most recently used cache dirs in parent """
+    if os.path.isdir(cache_path):
+        os.utime(cache_path, None)  # Mark it as used
+
+    entries = []
+    for name in os.listdir(parent):
+        path = os.path.join(parent, name)
+        if os.path.isdir(path):
+            entries.append((os.stat(path).st_mtime, path))
+    entries.sort(reverse=True)
+    for _, path in entries[keep:]:
+        if path != cache_path:
+            log.debug('Removing old cache %s', path)
+            shutil.rmtree(path, ignore_errors=True)
+
+
 def page_output(f):
     @click.option('--pager/--nopager', default=True)
     @functools.wraps(f)
@@ -202,7 +343,7 @@ def page_output(f):
 
 @contextlib.contextmanager
 def _page_output(skip):
-    if skip or not sys.stdout.isatty():
+    if skip or not sys.stdout.isatty() or os.environ.get('PAGER') == 'cat':
         yield
         return
 
@@ -211,7 +352,8 @@ def _page_output(skip):
         pipe_rd, pipe_wr = os.pipe()
         pager = subprocess.Popen(['less', '-F', '-R', '-S', '-X', '-K'],
                                  stdin=os.fdopen(pipe_rd, 'r'), close_fds=True)
-        pipe_output = os.fdopen(pipe_wr, 'a', 0)
+        # Line buffered, so output still shows up in the pager as soon as each line is ready
+        pipe_output = os.fdopen(pipe_wr, 'w', 1)
         try:
             with contextlib.redirect_stdout(pipe_output):
                 yield
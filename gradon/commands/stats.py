@@ -1,11 +1,8 @@
-from __future__ import print_function
-
 import click
 import tqdm
 
 from .. import core
 from . import shared
-from .. import tools
 
 
 @shared.git_log_args
@@ -20,8 +17,8 @@ def command(ctx, rev_range=None, **options):
     source_repo = ctx.obj['repo']
     stats_fs = ctx.obj['fs_class'](ctx.obj['default_cache_path'], init=options['force'])
 
-    total, source_shas = tools.tee_count(
-        core.generate_shas_for_source_range(source_repo, rev_range))
+    total = core.count_commits_for_source_range(source_repo, rev_range)
+    source_shas = core.generate_shas_for_source_range(source_repo, rev_range)
 
     fs_commits = core.generate_stats_fs_commits_for_source_commits(
         stats_fs, source_repo, source_shas)
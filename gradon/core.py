@@ -1,24 +1,21 @@
-from __future__ import print_function
-from builtins import zip
-
-import collections
 import contextlib
 import itertools
 import logging
+import multiprocessing
 import os
 import re
 import shutil
 import sys
 import tempfile
 import time
-import yaml
 
 import git
-import six
+from git.objects.util import altz_to_utctz_str
 import tqdm
 
-from gradon import tools
+from gradon import file_system
 from gradon import stats
+from gradon import tools
 from gradon import stats_fs_adapter
 
 from .commands import shared
@@ -27,29 +24,46 @@ log = logging.getLogger(__name__)
 
 DEFAULT_GRADON_REPO_PATH = '.gradon'
 
+_SHA_RE = re.compile(r'^\w+')
+
 
 def _get_sha_from_message(message):
-    return re.search(r'^\w+', message).group(0)
+    return _SHA_RE.match(message).group(0)
 
 
-def _format_datetime_for_git(dt):
-    # Internal git datetime format (see http://stackoverflow.com/questions/14023794/specification-for-syntax-of-git-dates)  # noqa
-    return dt.strftime('%Y-%m-%d %H:%M:%S %z')
+def _format_date_for_git(timestamp, tz_offset):
+    # Internal git date format, '<unix timestamp> <utc offset>', which is also what GitPython
+    # stores, so no datetime conversion is needed
+    return '{} {}'.format(timestamp, altz_to_utctz_str(tz_offset))
 
 
-def _generate_changed_files(prev_commit, commit):
+def _generate_changed_files(repo, prev_sha, sha):
     """ Yields pairs of source->dest changed files """
-    for diff in prev_commit.diff(commit.hexsha):
-        if (diff.a_path or diff.b_path).endswith('.stats.yaml'):
-            yield ((None if diff.new_file else diff.a_path),
-                   (None if diff.deleted_file else diff.b_path))
+    for change in tools.generate_tree_changes(repo, prev_sha, sha, find_renames=True):
+        if (change.a_path or change.b_path).endswith('.stats.yaml'):
+            yield change.a_path, change.b_path
+
+
+class Stats(object):
+    """ Stats for one changed stats file in a commit
+
+    A plain class with __slots__ rather than a namedtuple, since it is cheaper to construct and
+    one is built for every row.
+    """
+    __slots__ = ('filename', 'commit', 'lines', 'lines_test', 'lines_non_test', 'delta', 'after')
 
-Stats = collections.namedtuple('Stats',
-                               ('filename', 'commit', 'lines', 'lines_test', 'lines_non_test',
-                                'delta', 'after'))
+    def __init__(self, filename, commit, lines, lines_test, lines_non_test, delta, after):
+        self.filename = filename
+        self.commit = commit
+        self.lines = lines
+        self.lines_test = lines_test
+        self.lines_non_test = lines_non_test
+        self.delta = delta
+        self.after = after
 
 
-def generate_stats_for_stats_fs_commits(stats_fs, shas, filters=None, test_patterns=()):
+def generate_stats_for_stats_fs_commits(stats_fs, shas, filters=None, test_patterns=(),
+                                        parallel=False):
     """ Generates stats for an iterator of commits
 
     Args:
@@ -58,79 +72,146 @@ def generate_stats_for_stats_fs_commits(stats_fs, shas, filters=None, test_patte
         reversed: Whether the commits are in the reverse order of the original git commits
         filters: Return only stats for the given filters
         test_patterns: Regexp for patterns considered to be tests
+        parallel (boolean): Generate stats for several commits at once in worker processes.  All
+            of shas is read before the first stats are generated.
 
         Yields: rows of stats
     """
 
     empty_sha = stats_fs.repo.git.hash_object('/dev/null', t='tree')
+    test_patterns = tools.compile_any(test_patterns)
+    if filters is not None:
+        filters = tools.compile_any(filters)
+
+    if not parallel:
+        for current_sha in shas:
+            for s in _generate_stats_for_stats_fs_commit(stats_fs, current_sha, empty_sha,
+                                                         filters, test_patterns):
+                yield s
+        return
+
+    # Workers open their own copy of the repo, so only shas and stats cross process boundaries
+    shas = list(shas)
+    pool = multiprocessing.Pool(initializer=_init_stats_worker,
+                                initargs=(stats_fs.path, empty_sha, filters, test_patterns))
+    try:
+        for current_sha, rows in zip(shas, pool.imap(_stats_worker, shas, chunksize=8)):
+            commit = tools.load_commit(stats_fs.repo, current_sha)
+            for s in rows:
+                s.commit = commit
+                yield s
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+_stats_worker_args = None
+
+
+def _init_stats_worker(stats_fs_path, empty_sha, filters, test_patterns):
+    global _stats_worker_args
+    _stats_worker_args = (file_system.GitStatsFileSystem(stats_fs_path), empty_sha, filters,
+                          test_patterns)
 
-    for current_sha in shas:
-        log.info("Generating stats for '{}'".format(current_sha))
-        commit = stats_fs.repo.commit(current_sha)
-        prev_sha = _get_parent_sha(stats_fs.repo, current_sha, empty_sha)
-        line_changes = yaml.safe_load(
-            stats_fs.repo.git.show(current_sha + ':' + 'LATEST_CHANGES.yaml'))
 
-        changed_files = set(_generate_changed_files(stats_fs.repo.commit(prev_sha), commit))
+def _stats_worker(current_sha):
+    stats_fs, empty_sha, filters, test_patterns = _stats_worker_args
+    rows = list(_generate_stats_for_stats_fs_commit(
+        stats_fs, current_sha, empty_sha, filters, test_patterns))
+    for s in rows:
+        s.commit = None
+    return rows
 
-        for src, dest in ((s, d) for s, d in changed_files):
-            before = after = None
 
-            if src:
-                before = stats_fs_adapter.read_stats_file(
-                    stats_fs.repo.git.show(prev_sha + ':' + src))
+def _generate_stats_for_stats_fs_commit(stats_fs, current_sha, empty_sha, filters, test_patterns):
+    """ Generates stats for the changes in a single stats fs commit """
+    log.info("Generating stats for '{}'".format(current_sha))
+    commit = tools.load_commit(stats_fs.repo, current_sha)
+    parents = commit.parents
+    prev_sha = parents[0].hexsha if parents else empty_sha
+    changed_files = set(_generate_changed_files(stats_fs.repo, prev_sha, current_sha))
 
-            if dest:
-                after = stats_fs_adapter.read_stats_file(
-                    stats_fs.repo.git.show(current_sha + ':' + dest))
+    # Skip stats files (and whole commits) that can't produce a row before loading anything
+    if filters is not None:
+        changed_files = set((src, dest) for src, dest in changed_files
+                            if any(f is not None and filters.search(f) for f in (src, dest)))
+        if not changed_files:
+            return
 
-            if before is None:
-                before = stats.zero_series(after)
+    line_changes = tools.load_yaml(
+        stats_fs.read_blob(current_sha, 'LATEST_CHANGES.yaml'))
 
-            if after is None:
-                after = stats.zero_series(before)
+    # Classify each changed line entry once per commit, rather than once per changed stats file
+    line_deltas = [
+        (entry,
+         (change_stats['lines'], change_stats['insertions'], change_stats['deletions']),
+         test_patterns.search(os.path.basename(entry)) is not None)
+        for entry, change_stats in line_changes.items()]
+    line_totals = {}
 
-            diff = after - before
+    for src, dest in changed_files:
+        before = after = None
 
-            # For deletes/renames, create two entries, one for src and one for dest
-            for file in {v for v in [src, dest] if v is not None}:
-                filename = file.replace('.stats.yaml', '')
-                sign = 1 if file == dest else -1  # Flip the diff for deletes
+        if src:
+            with stats_fs.stream_blob(prev_sha, src) as stream:
+                before = stats_fs_adapter.read_stats_file(stream)
 
-                if (filters is not None and
-                        not any(re.search(p, file) for p in filters)):
-                    continue
+        if dest:
+            with stats_fs.stream_blob(current_sha, dest) as stream:
+                after = stats_fs_adapter.read_stats_file(stream)
 
-                if filename.endswith('.py'):
-                    prefix = filename
-                else:
-                    prefix = os.path.dirname(filename)
+        if before is None:
+            before = stats.zero_series(after)
+
+        if after is None:
+            after = stats.zero_series(before)
+
+        diff = after - before
+
+        # For deletes/renames, create two entries, one for src and one for dest
+        for file in {v for v in [src, dest] if v is not None}:
+            filename = file[:-len('.stats.yaml')] if file.endswith('.stats.yaml') else file
+            sign = 1 if file == dest else -1  # Flip the diff for deletes
 
-                def generate_deltas():
-                    for entry, change_stats in six.iteritems(line_changes):
-                        if prefix and not entry.startswith(prefix):
-                            continue
+            if filters is not None and filters.search(file) is None:
+                continue
 
-                        basename = os.path.basename(entry)
-                        is_test = any(re.search(regex, basename) for regex in test_patterns)
+            if filename.endswith('.py'):
+                prefix = filename
+            else:
+                prefix = os.path.dirname(filename)
 
-                        line_delta = (change_stats['lines'], change_stats['insertions'],
-                                      change_stats['deletions'])
+            # Aggregate stats files in the same directory share a prefix, so sum it only once
+            try:
+                total, total_test, total_non_test = line_totals[prefix]
+            except KeyError:
+                total, total_test, total_non_test = line_totals[prefix] = _sum_line_deltas(
+                    line_deltas, prefix)
 
-                        yield line_delta, is_test
+            yield Stats(filename, commit, total, total_test, total_non_test, diff.mul(sign),
+                        after)
 
-                total, total_test, total_non_test = [(0, 0, 0)] * 3
-                for line_delta, is_test in generate_deltas():
-                    total = tuple(orig + delta for orig, delta in zip(total, line_delta))
-                    if is_test:
-                        total_test = tuple(orig + delta for orig, delta in
-                                           zip(total_test, line_delta))
-                    else:
-                        total_non_test = tuple(orig + delta for orig, delta in
-                                               zip(total_non_test, line_delta))
 
-                yield Stats(filename, commit, total, total_test, total_non_test, diff.mul(sign),
-                            after)
+def _sum_line_deltas(line_deltas, prefix):
+    """ Returns (total, test, non-test) line change tuples for entries starting with prefix """
+    # Plain local counters, which are much cheaper to update than list or array items
+    lines = insertions = deletions = 0
+    test_lines = test_insertions = test_deletions = 0
+    for entry, (entry_lines, entry_insertions, entry_deletions), is_test in line_deltas:
+        if prefix and not entry.startswith(prefix):
+            continue
+
+        lines += entry_lines
+        insertions += entry_insertions
+        deletions += entry_deletions
+        if is_test:
+            test_lines += entry_lines
+            test_insertions += entry_insertions
+            test_deletions += entry_deletions
+
+    return ((lines, insertions, deletions),
+            (test_lines, test_insertions, test_deletions),
+            (lines - test_lines, insertions - test_insertions, deletions - test_deletions))
 
 
 def update_stats_fs_from_repo(stats_fs, source_repo, rev_range=None, test_patterns=(),
@@ -161,8 +242,8 @@ def update_stats_fs_from_repo(stats_fs, source_repo, rev_range=None, test_patter
             log.info('Restarting from commit {}'.format(start_sha), file=sys.stderr)
             stats_fs.repo.head.reset(dest_start_sha, index=True, working_tree=True)
 
-    total, source_shas = tools.tee_count(
-        generate_shas_for_source_range(source_repo, rev_range))
+    total = count_commits_for_source_range(source_repo, rev_range)
+    source_shas = generate_shas_for_source_range(source_repo, rev_range)
 
     stats_fs_commits = generate_stats_fs_commits_for_source_commits(
         stats_fs, source_repo, source_shas, incremental=incremental, paths=paths,
@@ -183,7 +264,11 @@ def _clone_source_repo(source_repo):
 
 
 def _get_parent_sha(repo, sha, default=None):
-    parents = repo.commit(sha).parents
+    return _get_commit_parent_sha(repo.commit(sha), default)
+
+
+def _get_commit_parent_sha(commit, default=None):
+    parents = commit.parents
     if parents:
         return parents[0].hexsha
     else:
@@ -194,16 +279,67 @@ def generate_shas_for_source_range(source_repo, rev_range, reverse=False):
     return (c.hexsha for c in source_repo.iter_commits(rev_range, reverse=(not reverse)))
 
 
+def count_commits_for_source_range(source_repo, rev_range):
+    """ Counts the commits generate_shas_for_source_range will yield, without walking them """
+    return int(source_repo.git.rev_list('--count', rev_range or 'HEAD'))
+
+
+def list_stats_fs_commits(stats_fs):
+    """ Returns the shas of the stats commits already in stats_fs, oldest first
+
+    '[ignore]' commits, which only hold the state before each source commit, are skipped.
+    """
+    if stats_fs.head_message is None:
+        return []
+    return [c.hexsha for c in stats_fs.repo.iter_commits(reverse=True)
+            if not c.message.startswith('[ignore]')]
+
+
+def map_stats_fs_commits(stats_fs):
+    """ Returns a dict of source commit sha to the stats commit generated for it in stats_fs """
+    if stats_fs.head_message is None:
+        return {}
+    return {c.message.split('\n', 1)[0]: c.hexsha
+            for c in stats_fs.repo.iter_commits(reverse=True)
+            if not c.message.startswith('[ignore]')}
+
+
+def generate_cached_stats_fs_commits(stats_fs, source_repo, source_shas, reversed=False,
+                                     **kwargs):
+    """ Yields the stats commit for each of source_shas, generating only the missing ones
+
+    Stats commits are generated incrementally against the first parent of their source commit,
+    so each one holds the changes for its source commit no matter what was generated before it
+    or which range it was generated for.  That lets new source commits be added to an existing
+    stats_fs, and the commits are yielded in the order of source_shas.  Runs of missing
+    shas are generated together, with the rest of the arguments passed on to
+    generate_stats_fs_commits_for_source_commits.
+    """
+    cached = map_stats_fs_commits(stats_fs)
+    for is_cached, shas in itertools.groupby(source_shas, key=lambda sha: sha in cached):
+        if is_cached:
+            for sha in shas:
+                yield cached[sha]
+        else:
+            for fs_commit in generate_stats_fs_commits_for_source_commits(
+                    stats_fs, source_repo, iter(list(shas)), reversed=reversed,
+                    incremental=True, **kwargs):
+                yield fs_commit
+
+
 def generate_stats_fs_commits_for_source_commits(
         stats_fs, source_repo, source_shas, test_patterns=(), exclude_patterns=(),
         paths=None, incremental=False, parallel=False, reversed=False,
         debug=False):
-
-    with _clone_source_repo(source_repo) as source_repo:
+    # Compile the patterns once, rather than on every update
+    test_patterns = tools.compile_any(test_patterns)
+    exclude_patterns = tools.compile_any(exclude_patterns)
+
+    with _clone_source_repo(source_repo) as source_repo, \
+            stats.StatsUpdater(source_repo.working_tree_dir, stats_fs,
+                               test_patterns=test_patterns, parallel=parallel,
+                               debug=debug) as stats_updater:
         empty_sha = source_repo.git.hash_object('/dev/null', t='tree')
-        stats_updater = stats.StatsUpdater(source_repo.working_tree_dir, stats_fs,
-                                           test_patterns=test_patterns, parallel=parallel,
-                                           debug=debug)
 
         # Generate initial data if necessary and not incremental
         if not incremental and stats_fs.head_message is None:
@@ -236,20 +372,22 @@ def generate_stats_fs_commits_for_source_commits(
         for current_sha, prev_sha in zip(source_shas, prev_shas):
             log.info("Generating fs stats for '{}'".format(current_sha))
 
-            if prev_sha is None:
-                prev_sha = _get_parent_sha(source_repo, current_sha, empty_sha)
-
-            commit = source_repo.commit(current_sha)
-            changed_files = set(p for diffs in commit.diff(prev_sha)
-                                for p in (diffs.a_path, diffs.b_path))
+            commit = tools.load_commit(source_repo, current_sha)
+            if prev_sha is None or incremental:
+                # Incremental commits are always against the first parent, not the previous sha in
+                # the range, so they don't depend on what was generated before them
+                prev_sha = _get_commit_parent_sha(commit, empty_sha)
+            changed_files = set(p for change in tools.generate_tree_changes(
+                                    source_repo, prev_sha, current_sha)
+                                for p in (change.a_path, change.b_path) if p is not None)
 
             if incremental:
                 if prev_sha != empty_sha:
                     source_repo.head.reset(commit=prev_sha, index=True, working_tree=True)
-                    stats_updater.update(changed_files, paths=paths,
-                                         ignore_patterns=exclude_patterns)
                 else:
-                    stats_updater.update((), paths=paths, ignore_patterns=exclude_patterns)
+                    # A root commit's files are all new, so remove any stats left for them
+                    source_repo.git.read_tree(empty_sha, reset=True, u=True)
+                stats_updater.update(changed_files, paths=paths, ignore_patterns=exclude_patterns)
                 stats_fs.commit('[ignore] ' + current_sha + '\n')
 
             source_repo.head.reset(commit=current_sha, index=True, working_tree=True)
@@ -265,17 +403,20 @@ def generate_stats_fs_commits_for_source_commits(
                     update_times = []
                     start = time.time()
 
+            # Commit.stats runs git on every access, so only fetch it once
+            commit_stats = commit.stats
             with stats_fs.add_file('LATEST_CHANGES.yaml') as f:
-                yaml.safe_dump(commit.stats.files, f, default_flow_style=False)
+                tools.dump_yaml(commit_stats.files, f)
             with stats_fs.add_file('LATEST_CHANGES_TOTAL.yaml') as f:
-                yaml.safe_dump(commit.stats.total, f, default_flow_style=False)
+                tools.dump_yaml(commit_stats.total, f)
 
             yield stats_fs.commit(commit.hexsha + '\n' + commit.message,
                                   author=commit.author,
-                                  author_date=_format_datetime_for_git(commit.authored_datetime),
+                                  author_date=_format_date_for_git(commit.authored_date,
+                                                                   commit.author_tz_offset),
                                   committer=commit.committer,
-                                  commit_date=_format_datetime_for_git(
-                                      commit.committed_datetime))
+                                  commit_date=_format_date_for_git(commit.committed_date,
+                                                                   commit.committer_tz_offset))
 
 
 def generate_stats_fs_commit_for_diff(
@@ -286,37 +427,35 @@ def generate_stats_fs_commit_for_diff(
     commit = source_repo.commit(first_rev)
     diff = commit.diff(second_rev)
     log.info('Generating diff between {} and {}'.format(first_rev, second_rev or '<working tree>'))
-    changed_files = set(p for diffs in diff for p in (diffs.a_path, diffs.b_path))
+    changed_files = set(p for diffs in diff for p in (diffs.a_path, diffs.b_path)
+                        if p is not None)
     diff_stats = git.Stats._list_from_string(
         source_repo, source_repo.git.diff(first_rev, second_rev, numstat=True))
 
-    before_sha = source_repo.commit(first_rev).hexsha
+    before_sha = commit.hexsha
     with _clone_source_repo(source_repo) as working_source_repo:
         working_source_repo.head.reset(commit=before_sha,
                                        index=True, working_tree=True)
-        stats_updater = stats.StatsUpdater(working_source_repo.working_tree_dir, stats_fs,
-                                           test_patterns=test_patterns, parallel=parallel,
-                                           debug=debug)
-        stats_updater.update(changed_files, paths=paths, ignore_patterns=exclude_patterns)
+        with stats.StatsUpdater(working_source_repo.working_tree_dir, stats_fs,
+                                test_patterns=test_patterns, parallel=parallel,
+                                debug=debug) as stats_updater:
+            stats_updater.update(changed_files, paths=paths, ignore_patterns=exclude_patterns)
         stats_fs.commit('[ignore] ' + before_sha)
 
         repo = (source_repo if second_rev is None else working_source_repo)
-        after_stats_updater = stats.StatsUpdater(
-            repo.working_tree_dir,
-            stats_fs,
-            test_patterns=test_patterns, parallel=parallel,
-            debug=debug)
-
         if second_rev is not None:
             after_sha = source_repo.commit(second_rev).hexsha
             working_source_repo.head.reset(commit=after_sha, index=True, working_tree=True)
 
-        after_stats_updater.update(changed_files, paths=paths, test_patterns=test_patterns,
-                                   ignore_patterns=exclude_patterns)
+        with stats.StatsUpdater(repo.working_tree_dir, stats_fs,
+                                test_patterns=test_patterns, parallel=parallel,
+                                debug=debug) as after_stats_updater:
+            after_stats_updater.update(changed_files, paths=paths, test_patterns=test_patterns,
+                                       ignore_patterns=exclude_patterns)
 
     with stats_fs.add_file('LATEST_CHANGES.yaml') as f:
-        yaml.safe_dump(diff_stats.files, f, default_flow_style=False)
+        tools.dump_yaml(diff_stats.files, f)
     with stats_fs.add_file('LATEST_CHANGES_TOTAL.yaml') as f:
-        yaml.safe_dump(diff_stats.total, f, default_flow_style=False)
+        tools.dump_yaml(diff_stats.total, f)
 
     return stats_fs.commit('{}..{}'.format(first_rev, second_rev or '<working tree>'))
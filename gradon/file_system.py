@@ -1,31 +1,30 @@
 import collections
 import contextlib
+import errno
+import io
 import logging
 import os
-import scandir
 import shutil
-import re
-
-
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import StringIO
-
-import six
+import threading
+from os import scandir
 
 import git
 import gitdb
 
+from . import tools
+
 log = logging.getLogger(__name__)
 
+# Errors that os.path.exists() would have reported as a missing path
+_MISSING_ERRNOS = (errno.ENOENT, errno.ENOTDIR)
+
 
 class FileSystem(object):
     def __init__(self, path):
         self._work_root = path
 
     def _normalize_path(self, path):
-        return re.sub(r'^\./', '', re.sub(r'/\./', '/', path))
+        return tools.normalize_path(path)
 
     @property
     def path(self):
@@ -50,34 +49,39 @@ class FileSystem(object):
             yield f
 
     def read(self, *path):
-        abs_file_path = self._abs_file_path(*path)
-        if os.path.exists(abs_file_path):
-            return open(abs_file_path).read()
-        else:
+        try:
+            with open(self._abs_file_path(*path)) as f:
+                return f.read()
+        except (IOError, OSError) as e:
+            if e.errno not in _MISSING_ERRNOS:
+                raise
             return None
 
     def ls_files(self, path):
-        if not os.path.exists(self._abs_dir_path(path)):
+        try:
+            return [e.name for e in scandir(self._abs_dir_path(path))]
+        except OSError as e:
+            if e.errno not in _MISSING_ERRNOS:
+                raise
             return []
-        return [e.name for e in scandir.scandir(self._abs_dir_path(path))]
 
     def ls_dirs(self, path):
-        return [e.name for e in scandir.scandir(self._abs_dir_path(path))
-                if (os.path.isdir(self._abs_dir_path(path, e.name)) and
-                    not e.name.startswith('.'))]
+        # DirEntry.is_dir() reuses the file type from the directory listing, saving a stat
+        return [e.name for e in scandir(self._abs_dir_path(path))
+                if e.is_dir() and not e.name.startswith('.')]
 
     def rm(self, path):
-        abs_file_path = self._abs_file_path(path)
-        if os.path.exists(abs_file_path):
-            os.remove(abs_file_path)
+        try:
+            os.remove(self._abs_file_path(path))
+        except OSError as e:
+            if e.errno not in _MISSING_ERRNOS:
+                raise
 
     def rmdir(self, path):
-        full_path = self._abs_dir_path(path)
-        if os.path.exists(full_path):
-            try:
-                os.rmdir(full_path)
-            except OSError:  # Ignore error when directory is not empty
-                pass
+        try:
+            os.rmdir(self._abs_dir_path(path))
+        except OSError:  # Ignore error when directory is missing or not empty
+            pass
 
 
 class CachedFileSystemMixin(object):
@@ -150,12 +154,15 @@ class CachedFileSystemMixin(object):
         return super(CachedFileSystemMixin, self).commit(message, **kwargs)
 
     def ls_stats(self, path):
-        if not os.path.exists(self._abs_dir_path(path)):
+        try:
+            entries = list(scandir(self._abs_dir_path(path)))
+        except OSError as e:
+            if e.errno not in _MISSING_ERRNOS:
+                raise
             return []
-        return [e.name.replace('.stats.yaml', '')
-                for e in scandir.scandir(self._abs_dir_path(path))
-                if (e.name.endswith('.stats.yaml') and
-                    not os.path.isdir(self._abs_dir_path(path, e.name)))]
+        return [e.name[:-len('.stats.yaml')]
+                for e in entries
+                if e.name.endswith('.stats.yaml') and not e.is_dir()]
 
 
 class GitStatsFileSystem(FileSystem):
@@ -166,6 +173,7 @@ class GitStatsFileSystem(FileSystem):
             self._repo = git.Repo.init(path)
         else:
             self._repo = git.Repo(path)
+        self._thread_local = threading.local()
         super(GitStatsFileSystem, self).__init__(self._repo.working_tree_dir)
 
     @property
@@ -194,15 +202,12 @@ class GitStatsFileSystem(FileSystem):
             env['GIT_COMMITTER_NAME'] = committer.name
         if 'commit_date' in kwargs:
             env['GIT_COMMITTER_DATE'] = kwargs.pop('commit_date')
-        old_env = self._repo.git.update_environment(**env)
-        try:
-            self._repo.git.add(all=True)
-            return self._repo.git.commit(message=message, allow_empty=True)
-        finally:
-            self._repo.git.update_environment(**old_env)
+        self._repo.git.add(all=True)
+        # Identities only apply to this git call, rather than swapping the shared git environment
+        return self._repo.git.commit(message=message, allow_empty=True, env=env)
 
     def rm(self, path):
-        abs_file_path = self._abs_file_path(*path)
+        abs_file_path = self._abs_file_path(path)
         if os.path.exists(abs_file_path):
             self._repo.git.rm(abs_file_path, ignore_unmatch=True)
 
@@ -222,6 +227,44 @@ class GitStatsFileSystem(FileSystem):
         sha, _ = message.split(' ', 1)
         return sha
 
+    def read_blob(self, rev, path=None):
+        """ Returns the contents of path at rev without forking a new git process
+
+        If path is None, rev must name the blob itself (e.g. its sha).  Reads go through a
+        persistent 'git cat-file --batch' process.
+        """
+        name = rev if path is None else '{}:{}'.format(rev, path)
+        _, _, _, data = self._reader_git.get_object_data(name)
+        return data
+
+    @contextlib.contextmanager
+    def stream_blob(self, rev, path=None):
+        """ Yields a binary stream over the contents of path at rev, like read_blob
+
+        The data is read straight from the persistent cat-file process rather than copied into a
+        single string first.  Anything left unread is drained on exit so the next read starts in
+        the right place.
+        """
+        name = rev if path is None else '{}:{}'.format(rev, path)
+        _, _, _, stream = self._reader_git.stream_object_data(name)
+        try:
+            yield stream
+        finally:
+            stream.read()
+
+    @property
+    def _reader_git(self):
+        """ A git command wrapper owned by the calling thread
+
+        The persistent cat-file process behind get_object_data can't be shared between threads,
+        so blob reads get their own per thread, separate from the one used by self.repo.
+        """
+        try:
+            return self._thread_local.git
+        except AttributeError:
+            self._thread_local.git = git.Git(self._repo.working_dir)
+            return self._thread_local.git
+
 
 class GitIndexStatsFileSystem(GitStatsFileSystem):
     def __init__(self, path, init=False):
@@ -233,6 +276,11 @@ class GitIndexStatsFileSystem(GitStatsFileSystem):
         self._dirty = False
         self._deferred_entries = []
         self._added_files = []
+        # Deferred files already in the index but not yet checked out
+        self._unsynced_paths = []
+        # Deferred blobs are written in-process; GitPython's own object db runs 'git hash-object'
+        # for every blob it stores
+        self._loose_odb = gitdb.LooseObjectDB(os.path.join(self._repo.git_dir, 'objects'))
 
     # TODO: enable this once we have a working tree elsewhere
     # def __del__(self):
@@ -241,6 +289,7 @@ class GitIndexStatsFileSystem(GitStatsFileSystem):
     def _flush(self):
         if self._added_files or self._deferred_entries:
             self._repo.index.add(self._deferred_entries + self._added_files)
+        self._unsynced_paths.extend(entry.path for entry in self._deferred_entries)
         del self._added_files[:]
         del self._deferred_entries[:]
 
@@ -248,7 +297,7 @@ class GitIndexStatsFileSystem(GitStatsFileSystem):
     def add_file(self, *path, **kwargs):
         deferred = kwargs.pop('deferred', False)
         if deferred:
-            stream = StringIO()
+            stream = io.StringIO()
             yield stream
         else:
             with super(GitIndexStatsFileSystem, self).add_file(*path) as f:
@@ -256,10 +305,10 @@ class GitIndexStatsFileSystem(GitStatsFileSystem):
 
         if deferred:
             data = stream.getvalue()
-            istream = self._repo.odb.store(gitdb.IStream('blob', len(data),
-                                                         six.BytesIO(data.encode())))
+            istream = self._loose_odb.store(gitdb.IStream('blob', len(data),
+                                                          io.BytesIO(data.encode())))
             blob = git.Blob(self._repo, istream.binsha, git.Blob.file_mode,
-                            self._rel_file_path(*path))
+                            self._normalize_path(self._rel_file_path(*path)))
             self._deferred_entries.append(git.IndexEntry.from_blob(blob))
         else:
             self._added_files.append(self._normalize_path(os.path.join(*path)))
@@ -267,8 +316,12 @@ class GitIndexStatsFileSystem(GitStatsFileSystem):
 
     def _sync_working_tree(self, path):
         if self._dirty:
+            # Files added normally are already on disk, so only deferred ones need checking out,
+            # including those flushed by a commit since the last sync
             self._flush()
-            self._repo.index.checkout(force=True)
+            if self._unsynced_paths:
+                self._repo.index.checkout(self._unsynced_paths, force=True)
+                del self._unsynced_paths[:]
             self._dirty = False
 
     def commit(self, message, **kwargs):
@@ -1,54 +1,75 @@
-from __future__ import print_function
-
-import csv
 import logging
 import sys
 
 from . import core
+from . import tools
 
 log = logging.getLogger(__name__)
 
+# Number of rows to collect before handing them to the csv writer
+ROW_BATCH_SIZE = 1024
 
-def fs_commits_to_csv(stats_fs, fs_commits, csv_file, test_patterns=(), filters=None):
-    csv_writer = csv.writer(csv_file)
 
+def fs_commits_to_csv(stats_fs, fs_commits, csv_writer, test_patterns=(), filters=None,
+                      parallel=False):
+    """ Writes a row per stats change to csv_writer, in batches of ROW_BATCH_SIZE rows """
     header_written = False
+    rows = []
 
     old_commit = None
+    commit_fields = None
     stats_iter = core.generate_stats_for_stats_fs_commits(
-        stats_fs, fs_commits, test_patterns=test_patterns, filters=filters)
-    for stats_data in stats_iter:
-        if old_commit != stats_data.commit:
-            old_commit = stats_data.commit
-        artifact = stats_data.filename.replace('/', '.')  # Use module name instead of file
-        commit = stats_data.commit
-
-        if not header_written:
-            headers = tuple('.'.join(t) for t in stats_data.delta.index)
-            csv_writer.writerow(
-                ('Commit Time', 'Author', 'SHA', 'Artifact') +
-                ('Total Lines', 'Inserted Lines', 'Deleted Lines') +
-                ('Test Total Lines', 'Test Inserted Lines', 'Test Deleted Lines') +
-                ('Non-test Total Lines', 'Non-test Inserted Lines',
-                 'Non-test Deleted Lines') +
-                tuple(h + '(delta)' for h in headers) +
-                headers)
-            header_written = True
-
-        try:
-            commit_datetime = commit.committed_datetime
-        except ValueError as e:
-            print('Got strange datetime at {}: {}'.format(commit.committed_date, e),
-                  file=sys.stderr)
-            print(commit, file=sys.stderr)
-            continue
-
-        csv_writer.writerow((commit_datetime,
-                             commit.author.email,
-                             commit.hexsha,
-                             artifact) +
-                            stats_data.lines +
-                            stats_data.lines_test +
-                            stats_data.lines_non_test +
-                            tuple(stats_data.delta) +
-                            tuple(stats_data.after))
+        stats_fs, fs_commits, test_patterns=test_patterns, filters=filters, parallel=parallel)
+    if not parallel:
+        # Generate stats in the background while earlier rows are written.  Commit objects load
+        # lazily through the stats repo's shared git process, so load them in the same thread.
+        # In parallel the work is already done by worker processes, and the pool must not be
+        # forked from a background thread.
+        stats_iter = tools.prefetch(stats_iter, prepare=lambda stats: stats.commit.message)
+    try:
+        for stats_data in stats_iter:
+            commit = stats_data.commit
+            if old_commit != commit:
+                old_commit = commit
+                try:
+                    commit_fields = (commit.committed_datetime, commit.author.email,
+                                     commit.hexsha)
+                except ValueError as e:
+                    print('Got strange datetime at {}: {}'.format(commit.committed_date, e),
+                          file=sys.stderr)
+                    print(commit, file=sys.stderr)
+                    commit_fields = None
+
+            if not header_written:
+                headers = tuple('.'.join(t) for t in stats_data.delta.index)
+                csv_writer.writerow(
+                    ('Commit Time', 'Author', 'SHA', 'Artifact') +
+                    ('Total Lines', 'Inserted Lines', 'Deleted Lines') +
+                    ('Test Total Lines', 'Test Inserted Lines', 'Test Deleted Lines') +
+                    ('Non-test Total Lines', 'Non-test Inserted Lines',
+                     'Non-test Deleted Lines') +
+                    tuple(h + '(delta)' for h in headers) +
+                    headers)
+                header_written = True
+
+            if commit_fields is None:
+                continue
+
+            row = list(commit_fields)
+            row.append(stats_data.filename.replace('/', '.'))  # Use module name instead of file
+            row.extend(stats_data.lines)
+            row.extend(stats_data.lines_test)
+            row.extend(stats_data.lines_non_test)
+            row.extend(stats_data.delta)
+            row.extend(stats_data.after)
+            rows.append(row)
+
+            if len(rows) >= ROW_BATCH_SIZE:
+                csv_writer.writerows(rows)
+                del rows[:]
+    finally:
+        stats_iter.close()
+
+    # Full batches are already written, but the trailing partial batch is only written once every
+    # row was made, so it is dropped after a failure
+    csv_writer.writerows(rows)
@@ -1,19 +1,19 @@
-from __future__ import print_function
-
 import collections
+import hashlib
 import heapq
+import io
 import itertools
 import logging
 import multiprocessing
+import operator
 import os
-import re
 import string
-import yaml
-
-from six.moves import map
-from six.moves import zip
+import sys
+import tokenize
+from os import scandir
 
-import scandir
+import numpy as np
+import pandas as pd
 import tqdm
 
 from radon import complexity
@@ -27,22 +27,36 @@ from . import tools
 
 log = logging.getLogger(__name__)
 
+# Number of directories whose files can be queued for analysis ahead of storing results
+MAX_PENDING_DIRS = 8
+
+# Number of analysis results to keep, by file contents
+ANALYSIS_CACHE_SIZE = 16384
+
 
 def tuple_to_dict(tup):
     return dict(tup._asdict())
 
 
 def scandirs_depth_first(root):
-    """Yield directory names not starting with '.' under given path."""
-    for dir_name in (e.name for e in scandir.scandir(root)
-                     if e.is_dir() and not e.name.startswith('.')):
-        for subdir_path in scandirs_depth_first(os.path.join(root, dir_name)):
-            yield os.path.join(dir_name, subdir_path)
-        yield dir_name
+    """Yield directory names not starting with '.' under given path, subdirectories first."""
+    # An explicit stack of (relative path prefix, open listing), rather than one generator per
+    # level that rejoins every path it passes up
+    stack = [('', scandir(root))]
+    while stack:
+        prefix, entries = stack[-1]
+        for e in entries:
+            if e.is_dir() and not e.name.startswith('.'):
+                stack.append((prefix + e.name + os.sep, scandir(e.path)))
+                break
+        else:
+            stack.pop()
+            if prefix:
+                yield prefix[:-len(os.sep)]
 
 
 def zero_series(series):
-    return series.apply(lambda v: 0)
+    return pd.Series(0, index=series.index, name=series.name)
 
 
 class AnalysisFailed(Exception):
@@ -50,20 +64,248 @@ class AnalysisFailed(Exception):
 
 
 def _preserve_integers(dct):
-    return {key: (int(value) if int(value) == value else value)
-            for key, value in dct.items()}
+    result = {}
+    for key, value in dct.items():
+        int_value = int(value)
+        result[key] = int_value if int_value == value else value
+    return result
+
+
+_OPEN_BRACKETS = frozenset('([{')
+_CLOSE_BRACKETS = frozenset(')]}')
+_LINE_END_TOKENS = frozenset([tokenize.NEWLINE, tokenize.NL])
+
+# The pure Python tokenizer reads lines as it needs them, which _get_all_tokens relies on
+_LAZY_TOKENIZER = sys.version_info < (3, 12)
+
+
+def _generate(code):
+    return list(tokenize.generate_tokens(io.StringIO(code).readline))
+
+
+def _get_all_tokens_slowly(line, lines):
+    """ Returns the tokens of the statement starting at line, the way radon finds them
+
+    Lines are added one at a time until the joined lines tokenize.  Returns the tokens plus the
+    number of extra lines used, and of lines in a multi-line string if the statement is one.
+    Raises StopIteration if lines run out first.
+    """
+    sloc_increment = multi_increment = 0
+    try:
+        tokens = _generate(line)
+    except tokenize.TokenError:
+        while True:
+            sloc_increment += 1
+            line = '\n'.join([line, next(lines)])
+            try:
+                tokens = _generate(line)
+            except tokenize.TokenError:
+                continue
+            if tokens[0][0] == tokenize.STRING and len(tokens) == 2:
+                # Multi-line string detected
+                multi_increment += line.count('\n') + 1
+            break
+    return tokens, sloc_increment, multi_increment
+
+
+def _get_all_tokens(line, lines, line_tokens=None):
+    """ Does what _get_all_tokens_slowly does, without going quadratic on multi-line code
+
+    That re-tokenizes a statement from its start for every extra line it needs, which is slow
+    for long multi-line strings and statements.  Instead the lines are fed to a single tokenizer,
+    and the statement is only tokenized in full after lines where it could end.
+
+    Most statements fit on one line, and each line is analyzed for the file and again for every
+    block it is in, so the tokens of single lines are kept in line_tokens if it is given.
+    """
+    try:
+        tokens = line_tokens[line]
+    except (KeyError, TypeError):
+        try:
+            tokens = _generate(line)
+        except tokenize.TokenError:
+            tokens = None
+        if line_tokens is not None:
+            line_tokens[line] = tokens
+    if tokens is not None:
+        return tokens, 0, 0
+    if not _LAZY_TOKENIZER:
+        return _get_all_tokens_slowly(line, lines)
+
+    joined = [line]
+    state = dict(reads=0, depth=0, last_type=None, done=False, tokens=None, error=None)
+
+    def could_end():
+        # Inside a string or brackets the statement can't be tokenized without more lines, and
+        # a trailing backslash is the only other way a line carries on
+        return ((state['depth'] == 0 and state['last_type'] in _LINE_END_TOKENS) or
+                joined[-1].endswith('\\'))
+
+    def readline():
+        # Only called once the tokens of every line read so far have been seen
+        if state['reads']:
+            if len(joined) > 1 and could_end():
+                try:
+                    state['tokens'] = _generate('\n'.join(joined))
+                except tokenize.TokenError:
+                    pass
+                except Exception as e:
+                    state['error'] = e
+                if state['tokens'] is not None or state['error'] is not None:
+                    state['done'] = True
+                    return ''
+            try:
+                joined.append(next(lines))
+            except StopIteration:
+                state['done'] = True
+                return ''
+        state['reads'] += 1
+        state['last_type'] = None
+        return joined[-1] + '\n'
+
+    try:
+        for token_type, token_string, _, _, _ in tokenize.generate_tokens(readline):
+            if state['done']:
+                break
+            if token_type == tokenize.OP:
+                if token_string in _OPEN_BRACKETS:
+                    state['depth'] += 1
+                elif token_string in _CLOSE_BRACKETS:
+                    state['depth'] -= 1
+            state['last_type'] = token_type
+    except Exception:
+        pass
+
+    if not state['done']:
+        # Leave anything unusual to the slow way, carrying on from the lines already read
+        return _get_all_tokens_slowly(line, itertools.chain(joined[1:], lines))
+    if state['error'] is not None:
+        raise state['error']
+    if state['tokens'] is None:
+        raise StopIteration
+
+    tokens = state['tokens']
+    multi_increment = 0
+    if tokens[0][0] == tokenize.STRING and len(tokens) == 2:
+        # Multi-line string detected
+        multi_increment = len(joined)
+    return tokens, len(joined) - 1, multi_increment
+
+
+def _logical(tokens):
+    """ Does what radon.raw._logical does in a single pass over the tokens
+
+    Each statement between semicolons is a logical line, or two if it has code after its last
+    colon (e.g. 'if x: return 0').  Statements with only comments and blank lines don't count.
+    """
+    lloc = 0
+    length = 0
+    colon = -1
+    has_code = False
+    for token in tokens:
+        token_type = token[0]
+        if token_type == tokenize.OP:
+            if token[1] == ';':
+                lloc += (2 - (colon == length - 2)) if colon >= 0 else int(has_code)
+                length = 0
+                colon = -1
+                has_code = False
+                continue
+            if token[1] == ':':
+                colon = length
+        elif token_type == tokenize.COMMENT:
+            continue
+        if token_type != tokenize.NL and token_type != tokenize.ENDMARKER:
+            has_code = True
+        length += 1
+    lloc += (2 - (colon == length - 2)) if colon >= 0 else int(has_code)
+    return lloc
+
+
+def _statement_tokens(line, lines, lineno, line_tokens=None):
+    """ Returns _get_all_tokens for a statement, raising SyntaxError if lines run out first """
+    try:
+        return _get_all_tokens(line, lines, line_tokens)
+    except StopIteration:
+        raise SyntaxError('SyntaxError at line: {0}'.format(lineno))
+
+
+def _analyze_raw(code, line_tokens=None):
+    """ Returns the raw metrics radon.raw.analyze gives for code, as a radon.raw.Module
+
+    This counts the same way, using the tokenizing above and radon's public
+    remove_python_documentation for the documentation lines.  line_tokens is passed on to
+    _get_all_tokens.
+    """
+    source_array = [line.strip() for line in code.split('\n') if line]
+    sloc = len(source_array)
+    loc, single_comments, multi = raw.remove_python_documentation(source_array)
+    lloc = comments = blank = 0
+    lines = iter(code.splitlines())
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            blank += 1
+            continue
+        tokens, _, _ = _statement_tokens(line, lines, lineno, line_tokens)
+        comments += sum(1 for token in tokens if token[0] == tokenize.COMMENT)
+        lloc += _logical(tokens)
+    return raw.Module(loc, lloc, sloc, comments, multi, blank, single_comments)
+
+
+def _block_lloc(block_code, line_tokens=None, line_lloc=None):
+    """ Returns the logical line count of a block of code
+
+    This is _analyze_raw(block_code).lloc without working out the other metrics, including
+    raising the same errors.  Most lines are single statements that also show up in the file and
+    in any enclosing blocks, so their counts are kept in line_lloc if it is given.  line_tokens
+    is passed on to _get_all_tokens.
+    """
+    if "'''" in block_code or '"""' in block_code:
+        # The documentation pass in _analyze_raw fails on some triple quoted strings, which makes
+        # the caller add lines to the block, so it has to be run for those
+        raw.remove_python_documentation([line.strip() for line in block_code.split('\n') if line])
+
+    lloc = 0
+    lines = iter(block_code.splitlines())
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            lloc += line_lloc[line]
+            continue
+        except (KeyError, TypeError):
+            pass
+        tokens, sloc_increment, _ = _statement_tokens(line, lines, lineno, line_tokens)
+        line_count = _logical(tokens)
+        if not sloc_increment and line_lloc is not None:
+            # Lines that tokenize on their own always count the same
+            line_lloc[line] = line_count
+        lloc += line_count
+    return lloc
+
+
+def _file_digest(path):
+    """ Returns a digest of a file's contents, or None if it can't be read """
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
 
 
 def _analyze_file(path):
     try:
         return _analyze_file_internal(path)
     except AnalysisFailed as e:
-        log.debug("Unable to analyze '{}': {}".format(path, e))
+        log.debug("Unable to analyze '%s': %s", path, e)
         return None
 
 
 def _analyze_file_internal(path):
-    lines = open(path).readlines()
+    with open(path) as f:
+        lines = f.readlines()
     code = ''.join(lines)
     try:
         ast = visitors.code2ast(code)
@@ -74,6 +316,10 @@ def _analyze_file_internal(path):
     halstead = metrics.h_visit_ast(ast)
 
     methods = []
+    # Lines are counted again for every block they are in and for the file, so keep their
+    # tokens and logical line counts while the file is analyzed
+    line_tokens = {}
+    line_lloc = {}
 
     grades = {g: 0 for g in string.ascii_uppercase[0:6]}
     for block in complexity_visitor.blocks:
@@ -86,7 +332,7 @@ def _analyze_file_internal(path):
             block_code = ''.join(lines[block.lineno - 1:endlineno])
             while True:
                 try:
-                    lloc = raw.analyze(block_code).lloc
+                    lloc = _block_lloc(block_code, line_tokens, line_lloc)
                     break
                 except Exception as e:
                     # Keep adding lines until we have the full block
@@ -94,16 +340,16 @@ def _analyze_file_internal(path):
                         block_code += lines[endlineno]
                         endlineno += 1
                     else:
-                        log.debug("Error: Unable to analyze '{}' at {}: {}".format(
-                            path, block.lineno, e))
+                        log.debug("Error: Unable to analyze '%s' at %s: %s",
+                                  path, block.lineno, e)
                         # Fall back to number of non-black lines
                         lloc = sum(1 for _ in (l for l in lines[block.lineno:block.endline+1] if l))
                         break
             grade = complexity.cc_rank(block.complexity)
-            methods.append({name: {grade: lloc}})
+            methods.append((name, {grade: lloc}))
             grades[grade] += lloc
     try:
-        stats = raw.analyze(code)
+        stats = _analyze_raw(code, line_tokens)
     except Exception as e:
         raise AnalysisFailed(e)
 
@@ -127,18 +373,36 @@ class StatsUpdater(object):
             source_root: Path to source tree
             dest_fs (StatsFileSystem): Destination for stats data
             debug (boolean): Print debug info
-            test_patterns: Regexes to identify test code
+            test_patterns: Regexes to identify test code, or the result of tools.compile_any
             parallel (boolean): Use multiple processes
         """
         self._source_root = source_root
         self._dest_fs = dest_fs
         self._dest_stats = stats_fs_adapter.create_adapter_for_fs(dest_fs)
         self._debug = debug
-        self._test_patterns = test_patterns
-        if parallel:
-            self._imap_processor = multiprocessing.Pool().imap
-        else:
-            self._imap_processor = map
+        self._test_regex = tools.compile_any(test_patterns)
+        self._parallel = parallel
+        self._pool = None
+        self._analysis_cache = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """ Stops the worker processes, if any were started """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _get_pool(self):
+        # Only start workers once there are files to analyze, and then keep them for later updates
+        if self._pool is None:
+            self._pool = multiprocessing.Pool()
+        return self._pool
 
     def _source_path(self, *parts):
         return os.path.join(self._source_root, *parts)
@@ -147,12 +411,14 @@ class StatsUpdater(object):
         return os.path.exists(os.path.join(self._source_root, *parts))
 
     def _store_stats(self, series, *path):
-        log.debug('Storing stats: {}'.format(os.path.join(*path)))
-        self._dest_stats.set(os.path.join(*path), series)
+        path = os.path.join(*path)
+        log.debug('Storing stats: %s', path)
+        self._dest_stats.set(path, series)
 
     def _load_stats(self, *path):
-        log.debug('Loading stats: {}'.format(os.path.join(*path)))
-        return self._dest_stats.get(os.path.join(*path), None)
+        path = os.path.join(*path)
+        log.debug('Loading stats: %s', path)
+        return self._dest_stats.get(path, None)
 
     def _remove_stats_file(self, *path):
         self._dest_stats.rm(os.path.join(*path))
@@ -163,17 +429,25 @@ class StatsUpdater(object):
     def _stats_dirs(self, *path):
         return self._dest_fs.ls_dirs(os.path.join(*path))
 
-    def _py_stats_files(self, *path):
-        return [f for f in self._dest_stats.ls(os.path.join(*path))
-                if f.endswith('.py')]
+    def _ls_stats_files(self, *path):
+        """ Returns the python stats files, python files and other stats files in a directory
 
-    def _py_method_files(self, *path):
-        return [f for f in self._dest_fs.ls_files(os.path.join(*path))
-                if f.endswith('.py')]
-
-    def _non_py_stats_files(self, *path):
-        return [f for f in self._dest_stats.ls(os.path.join(*path))
-                if not f.endswith('.py')]
+        Stats files are named by their source file, without the .stats.yaml suffix.  All three
+        come from a single listing of the directory.
+        """
+        py_stats_files = []
+        py_files = []
+        non_py_stats_files = []
+        for f in self._dest_fs.ls_files(os.path.join(*path)):
+            if f.endswith('.stats.yaml'):
+                f = f[:-len('.stats.yaml')]
+                if f.endswith('.py'):
+                    py_stats_files.append(f)
+                else:
+                    non_py_stats_files.append(f)
+            elif f.endswith('.py'):
+                py_files.append(f)
+        return py_stats_files, py_files, non_py_stats_files
 
     def update(self, changed_files=None, paths=None, test_patterns=(), ignore_patterns=(),
                progress=False):
@@ -190,6 +464,9 @@ class StatsUpdater(object):
             A set of changed directories
         """
 
+        ignore_regex = tools.compile_any(ignore_patterns)
+        if paths is not None:
+            paths = tuple(paths)
         dir_files_iter = self._generate_dirs_and_files(changed_files)
 
         if progress:
@@ -199,88 +476,159 @@ class StatsUpdater(object):
 
         dirty_dirs = set()
         bar = tqdm.tqdm(disable=(not progress), total=total, unit_scale=True, unit='directory')
-        for dir_path, files in dir_files_iter:
-            has_changes = self._visit_files_in_dir(dir_path, files, paths=paths,
-                                                   ignore_patterns=ignore_patterns)
-            if has_changes:
+
+        def finish_dir(dir_path, files, file_names, results):
+            if self._store_results_for_dir(dir_path, files, file_names, results):
                 dirty_dirs.add(dir_path)
                 self._aggregate_dir(dir_path)
             bar.update(1)
 
+        # When running in parallel, keep analyzing the files of the next few directories while
+        # the results for earlier ones are stored, rather than leaving the pool idle
+        pending = collections.deque()
+        for dir_path, files in dir_files_iter:
+            file_names = self._select_files_in_dir(dir_path, files, paths=paths,
+                                                   ignore_regex=ignore_regex)
+            get_results = self._start_analysis(
+                [self._source_path(dir_path, f) for f in file_names])
+            if not self._parallel:
+                finish_dir(dir_path, files, file_names, get_results())
+                continue
+
+            pending.append((dir_path, files, file_names, get_results))
+            if len(pending) > MAX_PENDING_DIRS:
+                dir_path, files, file_names, get_results = pending.popleft()
+                finish_dir(dir_path, files, file_names, get_results())
+
+        while pending:
+            dir_path, files, file_names, get_results = pending.popleft()
+            finish_dir(dir_path, files, file_names, get_results())
+
         if dirty_dirs:
             dirty_dirs.update(self._aggregate_subtrees(dirty_dirs))
 
         return dirty_dirs
 
-    def _visit_files_in_dir(self, dir_path, changed_files=None, paths=None, ignore_patterns=()):
-        if changed_files is None:
-            changed_files_iter = (e.name for e in scandir.scandir(self._source_path(dir_path)))
+    def _start_analysis(self, paths):
+        """ Starts analyzing paths, returning a function that returns their results in order
+
+        Results are cached by file contents, so files that are unchanged since they were last
+        analyzed (e.g. when checking out a commit's parent and then the commit) aren't parsed
+        again.
+        """
+        digests = [_file_digest(path) for path in paths]
+        hits = [digest is not None and digest in self._analysis_cache for digest in digests]
+        cached_results = [self._analysis_cache[digest] if hit else None
+                          for digest, hit in zip(digests, hits)]
+        misses = [path for path, hit in zip(paths, hits) if not hit]
+
+        if self._parallel and misses:
+            async_results = self._get_pool().map_async(_analyze_file, misses)
+        else:
+            async_results = None
+            fresh_results = map(_analyze_file, misses)
+
+        def get_results():
+            fresh_iter = iter(fresh_results if async_results is None else async_results.get())
+            results = []
+            for digest, hit, cached_result in zip(digests, hits, cached_results):
+                if hit:
+                    results.append(cached_result)
+                    continue
+
+                result = next(fresh_iter)
+                if digest is not None:
+                    if len(self._analysis_cache) >= ANALYSIS_CACHE_SIZE:
+                        self._analysis_cache.clear()
+                    self._analysis_cache[digest] = result
+                results.append(result)
+            return results
+
+        return get_results
+
+    def _select_files_in_dir(self, dir_path, changed_files=None, paths=None, ignore_regex=None):
+        """ Returns the names of the python files in dir_path that need analyzing
+
+        paths must be a tuple of path prefixes, if given.
+        """
+        if paths is not None and os.path.join(dir_path, '').startswith(paths):
+            # Every file in the directory starts with one of the prefixes
+            changed_files_iter = ()
+        elif changed_files is None:
+            changed_files_iter = (e.name for e in scandir(self._source_path(dir_path)))
         else:
             changed_files_iter = (f for f in changed_files if self._source_exists(dir_path, f))
 
-        files_to_analyze_iter = (
-            f for f in changed_files_iter
-            if (f.endswith('.py') and
-                (paths is None or
-                 not any(os.path.join(dir_path, f).startswith(p) for p in paths)) and
-                not any(re.search(pat, os.path.join(dir_path, f)) for pat in ignore_patterns)))
+        files_to_analyze = []
+        for f in changed_files_iter:
+            if not f.endswith('.py'):
+                continue
+            # Join each file's path once for all the filters
+            path = os.path.join(dir_path, f)
+            if ((paths is None or not path.startswith(paths)) and
+                    (ignore_regex is None or ignore_regex.search(path) is None)):
+                files_to_analyze.append(f)
 
         if self._debug:
-            log.debug("Visiting directory '{}'".format(dir_path))
-            files_to_analyze_iter, files_to_print = itertools.tee(files_to_analyze_iter)
-            files_to_print = list(files_to_print)
-            if files_to_print:
-                log.debug('Analyzing files: {}'.format(' '.join(files_to_print)))
+            log.debug("Visiting directory '%s'", dir_path)
+            if files_to_analyze:
+                log.debug('Analyzing files: %s', ' '.join(files_to_analyze))
 
-        files_to_analyze_iter, file_names_iter = itertools.tee(files_to_analyze_iter)
-        result_dicts = self._imap_processor(_analyze_file, (
-            self._source_path(dir_path, f) for f in files_to_analyze_iter))
+        return files_to_analyze
 
+    def _store_results_for_dir(self, dir_path, changed_files, file_names, result_dicts):
+        """ Stores analysis results and removes stale stats, returning whether anything changed """
         has_changes = False
-        for result_dict, file_name in zip(result_dicts, file_names_iter):
+        for result_dict, file_name in zip(result_dicts, file_names):
             if result_dict:
-                methods = result_dict.pop('methods')
-                series = stats_fs_adapter.dict_to_series(result_dict)
+                # Results may be cached, so leave them unchanged
+                methods = result_dict['methods']
+                series = stats_fs_adapter.dict_to_series(
+                    {k: v for k, v in result_dict.items() if k != 'methods'})
                 self._store_stats(series, dir_path, file_name)
                 has_changes = True
-                with self._dest_fs.add_file(dir_path, file_name + '.methods.yaml') as file:
-                    yaml.safe_dump(sorted(methods, key=lambda m: next(iter(m))), file)
+                self._dest_stats.set_methods(
+                    os.path.join(dir_path, file_name),
+                    [{name: value} for name, value in sorted(methods, key=operator.itemgetter(0))])
 
         # Remove stale stats files
+        py_stats_files, py_files, _ = self._ls_stats_files(dir_path)
         stale_stats_files = [
-            f for f in self._py_stats_files(dir_path) + self._py_method_files(dir_path)
+            f for f in py_stats_files + py_files
             if ((changed_files is None or f in changed_files) and
                 not self._source_exists(dir_path, f))]
 
-        log.debug('Removing stale files: {}'.format(' '.join(stale_stats_files)))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Removing stale files: %s', ' '.join(stale_stats_files))
 
         for stale_file in stale_stats_files:
             self._remove_stats_file(dir_path, stale_file)
+            self._dest_stats.rm_methods(os.path.join(dir_path, stale_file))
 
         return bool(has_changes or stale_stats_files)
 
     def _aggregate_dir(self, dir_path):
         totals = dict(TOTAL=None, TOTAL_TEST=None, TOTAL_NON_TEST=None)
-        individual_stats_files = self._py_stats_files(dir_path)
-
-        for stats_file in individual_stats_files:
-            series = self._load_stats(dir_path, stats_file)
-            if totals['TOTAL'] is None:
-                totals['TOTAL'] = zero_series(series)
-                totals['TOTAL_TEST'] = totals['TOTAL'].copy()
-                totals['TOTAL_NON_TEST'] = totals['TOTAL'].copy()
-
-            totals['TOTAL'] = totals['TOTAL'].add(series, fill_value=0)
-
-            basename = re.sub(r'.stats.yaml$', '', stats_file)
-            is_test = any(re.search(regex, basename) for regex in self._test_patterns)
-
-            if is_test:
-                totals['TOTAL_TEST'] = totals['TOTAL_TEST'].add(series, fill_value=0)
-            else:
-                totals['TOTAL_NON_TEST'] = totals['TOTAL_NON_TEST'].add(series, fill_value=0)
+        individual_stats_files, _, _ = self._ls_stats_files(dir_path)
 
         if individual_stats_files:
+            # Sum all the files at once rather than adding up their series one at a time
+            frame = pd.concat([self._load_stats(dir_path, stats_file)
+                               for stats_file in individual_stats_files], axis=1)
+            # The adapter lists the files by source name, without the .stats.yaml suffix
+            is_test = np.array([self._test_regex.search(stats_file) is not None
+                                for stats_file in individual_stats_files])
+            # A row per file, summed down the rows so values are added in file order
+            present = frame.notnull().values.T
+            values = np.ascontiguousarray(frame.fillna(0).values.T)
+
+            for name, rows in (('TOTAL', slice(None)),
+                               ('TOTAL_TEST', is_test),
+                               ('TOTAL_NON_TEST', ~is_test)):
+                # Like the files, each total only has the metrics found in its files (or the first)
+                metrics = present[rows].any(axis=0) | present[0]
+                totals[name] = pd.Series(values[rows].sum(axis=0)[metrics],
+                                         index=frame.index[metrics])
             for name, series in totals.items():
                 self._store_stats(series, dir_path, name)
         else:
@@ -289,10 +637,13 @@ class StatsUpdater(object):
                 self._remove_stats_file(dir_path, name)
 
     def _aggregate_subtree(self, dir_path):
+        """ Sums the subtree stats of a directory, returning whether any of them changed """
         subdirs = self._stats_dirs(dir_path)
-        log.debug("Aggregating stats directories ({}) in '{}'".format(' '.join(subdirs), dir_path))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Aggregating stats directories (%s) in '%s'", ' '.join(subdirs), dir_path)
         found_stats = set()
-        existing_totals = self._non_py_stats_files(dir_path)
+        has_changes = False
+        _, _, existing_totals = self._ls_stats_files(dir_path)
         for name in ('TOTAL', 'TOTAL_TEST', 'TOTAL_NON_TEST'):
             subtree_name = 'SUBTREE_' + name
             subtotal_paths = (path for path in
@@ -305,19 +656,27 @@ class StatsUpdater(object):
                     subtotal_stats.append(stats)
                     found_stats.add(subtotal_path[1:-1])  # Keep track of subdirs that exist
 
-            total = sum(subtotal_stats)
-            if total is 0:  # List was empty
+            if not subtotal_stats:
                 if subtree_name in existing_totals:
                     self._remove_stats_file(dir_path, subtree_name)
+                has_changes = True
             else:
-                self._store_stats(total, dir_path, subtree_name)
+                subtree_stats = sum(subtotal_stats)
+                # Leave totals that are the same as before alone, so unchanged parts of the tree
+                # aren't rewritten
+                if (subtree_name not in existing_totals or
+                        not subtree_stats.equals(self._load_stats(dir_path, subtree_name))):
+                    self._store_stats(subtree_stats, dir_path, subtree_name)
+                    has_changes = True
 
         # Next, remove any empty subdirectories
         for subdir in subdirs:
             if (subdir,) not in found_stats:
-                log.debug("Removing stats directory '{}'".format(os.path.join(dir_path, subdir)))
+                log.debug("Removing stats directory '%s'", os.path.join(dir_path, subdir))
                 self._remove_stats_dir(dir_path, subdir)
 
+        return has_changes
+
     def _aggregate_subtrees(self, dir_paths):
         # Use a heap to ensure that we process paths with the longest names first
         remaining_path_heap = []
@@ -330,12 +689,12 @@ class StatsUpdater(object):
             if dir_path in finished_paths:
                 continue
 
-            log.debug("Aggregating subtree '{}'".format(dir_path))
-
-            self._aggregate_subtree(dir_path)
+            log.debug("Aggregating subtree '%s'", dir_path)
 
-            parent_path = os.path.dirname(dir_path) or '.'
-            heapq.heappush(remaining_path_heap, (-len(parent_path), parent_path))
+            # The parent's subtree totals only need updating when this directory's have changed
+            if self._aggregate_subtree(dir_path):
+                parent_path = os.path.dirname(dir_path) or '.'
+                heapq.heappush(remaining_path_heap, (-len(parent_path), parent_path))
             finished_paths.add(dir_path)
 
         return finished_paths
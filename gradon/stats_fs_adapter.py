@@ -1,40 +1,50 @@
 import collections
 import logging
-import re
-import yaml
 
 import pandas as pd
-import six
-
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
 
 from . import file_system
+from . import tools
 
 log = logging.getLogger(__name__)
 
+# Number of stats series to keep in memory, and of distinct sets of metrics to share indexes for
+STATS_CACHE_SIZE = 65536
+INDEX_CACHE_SIZE = 1024
+
+_index_cache = {}
+
 
 def series_to_dict(series):
     dct = collections.defaultdict(dict)
-    for (category, metric), value in six.iteritems(series):
-        dct[category][metric] = float(value) if value != int(value) else int(value)
+    # Converting the index and values to lists up front gives plain Python numbers, which are
+    # much cheaper to test and convert than numpy scalars
+    for (category, metric), value in zip(series.index.tolist(), series.values.tolist()):
+        dct[category][metric] = int(value) if value == int(value) else value
     return dict(dct)
 
 
 def dict_to_series(dct):
-    return pd.DataFrame.from_dict(
-        collections.OrderedDict(sorted(
-            ((category, metric), [value])
-            for category, category_dict in six.iteritems(dct)
-            for metric, value in six.iteritems(category_dict))),
-        orient='index')[0]
+    items = sorted(((category, metric), value)
+                   for category, category_dict in dct.items()
+                   for metric, value in category_dict.items())
+    keys = tuple(key for key, _ in items)
+
+    # Stats files almost always have the same metrics, so share their index
+    try:
+        index = _index_cache[keys]
+    except KeyError:
+        if len(_index_cache) >= INDEX_CACHE_SIZE:
+            _index_cache.clear()
+        index = _index_cache[keys] = pd.Index(keys, tupleize_cols=False)
+
+    # Series have always been named 0, which shows up when they are printed
+    return pd.Series([value for _, value in items], index=index, name=0)
 
 
 def read_stats_file(contents):
-    dct = yaml.safe_load(contents)
-    return dict_to_series(dct)
+    """ Parses stats from a string, bytes or a binary stream of .stats.yaml data """
+    return dict_to_series(tools.load_stats(contents))
 
 
 class StatsFSAdapter(object):
@@ -43,7 +53,11 @@ class StatsFSAdapter(object):
 
     def set(self, path, series):
         with self._fs.add_file(path + '.stats.yaml') as f:
-            yaml.safe_dump(series_to_dict(series), f, default_flow_style=False)
+            tools.dump_stats(series_to_dict(series), f)
+
+    def set_methods(self, path, methods):
+        with self._fs.add_file(path + '.methods.yaml') as f:
+            tools.dump_methods(methods, f)
 
     def get(self, path, default=None):
         data = self._fs.read(path + '.stats.yaml')
@@ -55,8 +69,11 @@ class StatsFSAdapter(object):
     def rm(self, path):
         self._fs.rm(path + '.stats.yaml')
 
+    def rm_methods(self, path):
+        self._fs.rm(path + '.methods.yaml')
+
     def ls(self, path):
-        return [f.replace('.stats.yaml', '')
+        return [f[:-len('.stats.yaml')]
                 for f in self._fs.ls_files(path) if f.endswith('.stats.yaml')]
 
 
@@ -64,40 +81,58 @@ class GitStatsAdapter(StatsFSAdapter):
     def set(self, path, series):
         filename = path + '.stats.yaml'
         with self._fs.add_file(filename, deferred=True) as f:
-            log.debug("Writing file '{}'".format(filename))
-            yaml.safe_dump(series_to_dict(series), f, default_flow_style=False)
+            log.debug("Writing file '%s'", filename)
+            tools.dump_stats(series_to_dict(series), f)
+
+    def set_methods(self, path, methods):
+        with self._fs.add_file(path + '.methods.yaml', deferred=True) as f:
+            tools.dump_methods(methods, f)
 
 
 class CachedStatsFSAdapterMixin(object):
+    """ Keeps the most recently used stats in memory
+
+    Cached series are shared with callers rather than copied, so they must not be modified.
+    """
     def __init__(self,  *args, **kwargs):
         super(CachedStatsFSAdapterMixin, self).__init__(*args, **kwargs)
-        self._cache = {}
+        self._cache = collections.OrderedDict()
 
     def _normalize_path(self, path):
-        return re.sub(r'^\./', '', re.sub(r'/\./', '/', path))
+        return tools.normalize_path(path)
+
+    def _cache_series(self, path, series):
+        self._cache[path] = series
+        self._cache.move_to_end(path)
+        if len(self._cache) > STATS_CACHE_SIZE:
+            self._cache.popitem(last=False)
 
     def get(self, path, default=None):
         path = self._normalize_path(path)
         try:
-            data = self._cache[path]
+            series = self._cache[path]
         except KeyError:
-            log.debug('Cache stats miss: {}'.format(path))
+            log.debug('Cache stats miss: %s', path)
         else:
-            if data:
-                return pickle.loads(data)
-            else:
-                return None
+            self._cache.move_to_end(path)
+            return series
         series = super(CachedStatsFSAdapterMixin, self).get(path, default)
-        self._cache[path] = pickle.dumps(series)
+        self._cache_series(path, series)
         return series
 
     def set(self, path, series):
         path = self._normalize_path(path)
-        self._cache[path] = pickle.dumps(series)
+        cached = self._cache.get(path)
+        if cached is not None and cached.equals(series):
+            # Already stored, e.g. a total that the latest changes didn't affect
+            self._cache.move_to_end(path)
+            return
+        self._cache_series(path, series)
         return super(CachedStatsFSAdapterMixin, self).set(path, series)
 
     def rm(self, path):
-        self._cache[path] = None
+        path = self._normalize_path(path)
+        self._cache_series(path, None)
         return super(CachedStatsFSAdapterMixin, self).rm(path)
 
 
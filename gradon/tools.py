@@ -1,7 +1,209 @@
-import itertools
+import binascii
+import collections
+import json
+import queue
+import re
+import sys
+import threading
 
+import git
+import yaml
 
-def tee_count(iter):
+try:
+    from yaml import CSafeDumper as SafeDumper
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper
+    from yaml import SafeLoader
+
+
+def tee_count(iterable):
     """ Returns the a tuple of total entries plus a copy of the original iterator """
-    countable, copy = itertools.tee(iter)
-    return sum(1 for _ in countable), copy
+    # tee would buffer every item while counting anyway, so just keep them in a list
+    items = list(iterable)
+    return len(items), iter(items)
+
+
+_HEXSHA_RE = re.compile(r'^[0-9a-f]{40}$')
+_DOT_DIR_RE = re.compile(r'/\./')
+_LEADING_DOT_DIR_RE = re.compile(r'^\./')
+
+
+def normalize_path(path):
+    """ Removes './' components from a relative path """
+    return _LEADING_DOT_DIR_RE.sub('', _DOT_DIR_RE.sub('/', path))
+
+
+def load_commit(repo, sha):
+    """ Returns the commit for sha
+
+    Full hex shas are assumed to name commits, so the object is created directly instead of
+    asking git to resolve the name and look up its type first.  Its data is still read lazily.
+    """
+    if _HEXSHA_RE.match(sha):
+        return git.Commit(repo, binascii.unhexlify(sha))
+    return repo.commit(sha)
+
+
+def compile_patterns(patterns):
+    """ Returns a tuple of compiled regexes; patterns may be strings or already compiled """
+    return tuple(re.compile(pattern) for pattern in patterns)
+
+
+class AnyPattern(object):
+    """ Searches with each of several compiled regexes, like a regex matching any of them
+
+    The patterns are kept apart rather than joined into one alternation, so that their flags,
+    inline flags and group numbers still apply.
+    """
+    def __init__(self, patterns):
+        self.patterns = patterns
+
+    def search(self, string):
+        """ Returns the match of the first pattern found in string, or None """
+        for pattern in self.patterns:
+            match = pattern.search(string)
+            if match is not None:
+                return match
+        return None
+
+
+def compile_any(patterns):
+    """ Returns an AnyPattern that searches for any of patterns
+
+    Patterns may be strings or already compiled, and an AnyPattern from an earlier call is
+    returned as is.  With no patterns it never matches, the same as any() over an empty list.
+    """
+    if isinstance(patterns, AnyPattern):
+        return patterns
+    return AnyPattern(compile_patterns(patterns))
+
+
+def prefetch(iterable, size=32, prepare=None):
+    """ Yields the items of iterable, which is advanced in a background thread
+
+    Up to size items are read ahead.  If given, prepare is called on each item in the background
+    thread before it is handed over.  Exceptions raised by the iterable are re-raised here, and
+    the background thread stops when the returned generator is closed.
+    """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(value):
+        while not stop.is_set():
+            try:
+                items.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if prepare is not None:
+                    prepare(item)
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception:
+            put((done, sys.exc_info()))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, exc_info = items.get()
+            if item is done:
+                if exc_info:
+                    raise exc_info[1].with_traceback(exc_info[2])
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+TreeChange = collections.namedtuple('TreeChange',
+                                    ('status', 'a_path', 'b_path', 'a_blob', 'b_blob'))
+
+
+def generate_tree_changes(repo, a_rev, b_rev, find_renames=False):
+    """ Yields a TreeChange for every file that differs between two revisions
+
+    This parses the raw output of a single 'git diff-tree' call rather than building GitPython
+    Diff objects.  Paths and blob shas are None on the side where a file does not exist.
+
+    Args:
+        repo: The git.Repo to diff in
+        a_rev: The old revision
+        b_rev: The new revision
+        find_renames (boolean): Pair up renamed files instead of reporting a delete and an add
+    """
+    args = ['-r', '-z', a_rev, b_rev]
+    if find_renames:
+        args.insert(0, '-M')
+
+    fields = iter(repo.git.diff_tree(*args).split('\0'))
+    for header in fields:
+        if not header:  # Output ends with a NUL
+            continue
+        _, _, a_blob, b_blob, status = header.lstrip(':').split(' ')
+        status = status[0]
+        a_path = next(fields)
+        b_path = next(fields) if status in 'RC' else a_path
+        if status == 'A':
+            a_path = a_blob = None
+        elif status == 'D':
+            b_path = b_blob = None
+        yield TreeChange(status, a_path, b_path, a_blob, b_blob)
+
+
+def load_yaml(data):
+    """ Parses yaml data with the libyaml C parser when it is available """
+    return yaml.load(data, Loader=SafeLoader)
+
+
+def dump_yaml(data, stream):
+    """ Writes data as block-style yaml with the libyaml C emitter when it is available """
+    yaml.dump(data, stream, Dumper=SafeDumper, default_flow_style=False)
+
+
+def dump_methods(methods, stream):
+    """ Writes a list of method entries as JSON, which is also valid YAML """
+    json.dump(methods, stream)
+
+
+def load_methods(data):
+    """ Parses method entries written by dump_methods, or by older versions as YAML """
+    return _load_json_or_yaml(data)
+
+
+def dump_stats(stats, stream):
+    """ Writes a stats dict as JSON with sorted keys, which is also valid YAML """
+    stream.write(json.dumps(stats, sort_keys=True))
+
+
+def load_stats(data):
+    """ Parses a stats dict written by dump_stats, or by older versions as YAML
+
+    data may be a string, bytes or a binary stream.
+    """
+    if hasattr(data, 'read'):
+        data = data.read()
+    return _load_json_or_yaml(data)
+
+
+def _load_json_or_yaml(data):
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    try:
+        return json.loads(data)
+    except ValueError:
+        return load_yaml(data)
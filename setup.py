@@ -1,27 +1,19 @@
-import sys
-
 from setuptools import setup, find_packages
 
-install_requires = ()
-
-if sys.version_info < (3, 2):
-    install_requires += ('contextlib2',)
-
 setup(
     name='gradon',
     description='Nextdoor Gradon (Git + Radon == Gradon)',
     author='Andrew S. Brown',
     author_email='eng@nextdoor.com',
     packages=find_packages(exclude=['ez_setup']),
+    python_requires='>=3.5',
     scripts=['bin/gradon'],
-    install_requires=install_requires + (
-        'future>=0.15.2',
+    install_requires=(
         'gitpython',
         'click>=6.7',
         'pandas',
         'pyyaml',
         'radon',
-        'scandir',
         'tqdm',
     ),
     tests_require=[
@@ -9,3 +9,10 @@ def test_gradon_help():
     runner = CliRunner()
     result = runner.invoke(gradon.gradon, ['--help'])
     assert result.exit_code == 0
+
+
+def test_gradon_command_help():
+    runner = CliRunner()
+    for name in gradon.COMMANDS:
+        result = runner.invoke(gradon.gradon, [name, '--help'], obj={})
+        assert result.exit_code == 0, result.output
@@ -0,0 +1,47 @@
+import os
+import threading
+
+import git
+from click.testing import CliRunner
+
+from gradon import stats
+from gradon.commands import gradon
+
+import pytest  # noqa
+
+
+@pytest.fixture
+def source_repo(tmpdir):
+    repo = git.Repo.init(str(tmpdir.mkdir('my-source')))
+    repo.git.update_environment(
+        GIT_COMMITTER_EMAIL='noone@example.com', GIT_COMMITTER_NAME='No One',
+        GIT_AUTHOR_EMAIL='noone@example.com', GIT_AUTHOR_NAME='No One')
+    repo.git.commit(message='Initial commit', allow_empty=True)
+    for i, name in enumerate(('file.py', 'test_file.py', 'file.py')):
+        with open(os.path.join(repo.working_tree_dir, name), 'a') as f:
+            f.write('def foo{}(x):\n    if x:\n        return 1\n'.format(i))
+        repo.git.add(name)
+        repo.git.commit(message='Commit {}'.format(i))
+    return repo
+
+
+def _log(*args):
+    result = CliRunner().invoke(gradon.gradon, list(args) + ['log', '--nopager', '--no-cache'],
+                                obj={})
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def test_log_in_parallel(source_repo, monkeypatch):
+    """ Worker processes give the same log, and their pool is made on the main thread """
+    get_pool = stats.StatsUpdater._get_pool
+
+    def _get_pool(self):
+        assert threading.current_thread() is threading.main_thread()
+        return get_pool(self)
+
+    monkeypatch.setattr(stats.StatsUpdater, '_get_pool', _get_pool)
+    monkeypatch.chdir(source_repo.working_tree_dir)
+    serial = _log()
+    assert 'Commit 2' in serial
+    assert _log('-j') == serial
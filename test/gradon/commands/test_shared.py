@@ -0,0 +1,50 @@
+import os
+import re
+
+import git
+import pytest  # noqa
+
+from gradon.commands import shared
+
+
+@pytest.fixture
+def repo(tmpdir):
+    repo = git.Repo.init(str(tmpdir.mkdir('my-repo')))
+    for i in range(3):
+        repo.index.commit('commit {}'.format(i))
+    return repo
+
+
+def test_parse_rev_range_defaults_to_initial_commit(repo):
+    shas = [c.hexsha for c in repo.iter_commits()]
+    assert shared.parse_rev_range(None, repo) == (shas[-1], shas[0])
+
+
+def test_parse_rev_range(repo):
+    assert shared.parse_rev_range('HEAD~2..HEAD~1', repo) == ('HEAD~2', 'HEAD~1')
+    assert shared.parse_rev_range('HEAD~1', repo) == (None, 'HEAD~1')
+
+
+def test_diff_method_lists():
+    prev = ['a: A * 1', 'b: A * 2', 'b: A * 2', 'c: B * 3']
+    current = ['a: A * 1', 'b: A * 2', 'c: C * 4', 'd: A * 1']
+    assert shared._diff_method_lists(prev, current) == [
+        '- b: A * 2', '- c: B * 3', '+ c: C * 4', '+ d: A * 1']
+
+
+def test_cache_key_uses_whole_patterns():
+    """ Long patterns aren't cut short, and flags count """
+    prefix = 'x' * 300
+    assert (shared.cache_key((re.compile(prefix + 'a'),)) !=
+            shared.cache_key((re.compile(prefix + 'b'),)))
+    assert shared.cache_key(re.compile('a')) != shared.cache_key(re.compile('a', re.I))
+    assert shared.cache_key(re.compile('a')) == shared.cache_key(re.compile('a'))
+
+
+def test_command_cache_path_prunes_old_caches(tmpdir):
+    ctx = type('Context', (object,), {'obj': {'cache_dir': str(tmpdir.join('.gradon'))}})
+    for i in range(4):
+        with shared.command_cache_path(ctx, os.path.join('diff', str(i)), keep=2) as path:
+            os.makedirs(path)
+
+    assert sorted(os.listdir(str(tmpdir.join('.gradon.diff')))) == ['2', '3']
@@ -1,25 +1,121 @@
-import difflib
-import filecmp
+import os
 
+import git
+import gitdb
 import pytest
 
 
-class ComparableFile(object):
-    def __init__(self, path):
-        self.path = path
+# What 'git hash-object -t tree /dev/null' gives, which is the same for every repo
+EMPTY_TREE_SHA = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
 
-    def __eq__(self, file):
-        return filecmp.cmp(self.path, file.path)
 
-    def lines(self):
-        return open(self.path).readlines()
+def pytest_addoption(parser):
+    parser.addoption('--run-all-fs', action='store_true',
+                     help='Run every test with each stats file system class')
 
 
-@pytest.fixture(scope="module")
-def cmpfile():
-    return ComparableFile
+@pytest.fixture(scope="session")
+def empty_tree_sha():
+    """ Magic SHA for an empty source repo, useful for initial diffs """
+    # http://stackoverflow.com/questions/9765453/is-gits-semi-secret-empty-tree-object-reliable-and-why-is-there-not-a-symbolic  # noqa
+    return EMPTY_TREE_SHA
+
+
+@pytest.fixture(scope="session")
+def canonical_analysis(tmpdir_factory):
+    """ The analysis of a one-function source file, for tests that don't check the stats """
+    # Imported here so that collecting tests which don't need pandas doesn't import it
+    from gradon import stats
+
+    path = tmpdir_factory.mktemp('canonical').join('file.py')
+    path.write('def foo(): pass\n')
+    return stats._analyze_file(str(path))
+
+
+class InProcessGit(object):
+    """ Stands in for Repo.git, making adds and commits through GitPython's index
+
+    Unlike the git command line these don't start a process for every call.  Like git, commits
+    that change nothing raise GitCommandError unless allow_empty is set.  Any other git command
+    is passed on to the repo's real command wrapper.
+    """
+    def __init__(self, repo, author, committer, author_date, commit_date):
+        self._repo = repo
+        self._git = repo.git
+        self._author = author
+        self._committer = committer
+        self._author_date = author_date
+        self._commit_date = commit_date
+
+    def __getattr__(self, name):
+        return getattr(self._git, name)
+
+    def _working_tree_files(self):
+        root = self._repo.working_tree_dir
+        for dir_path, dir_names, file_names in os.walk(root):
+            # Skip git directories and nested repos, like the stats cache
+            dir_names[:] = [d for d in dir_names if d != '.git' and
+                            not os.path.exists(os.path.join(dir_path, d, '.git'))]
+            for file_name in file_names:
+                yield os.path.relpath(os.path.join(dir_path, file_name), root)
+
+    def _stage(self, include_untracked):
+        """ Returns the index, with every file in the working tree (or just tracked ones) staged """
+        index = self._repo.index
+        tracked = set(path for path, _ in index.entries)
+        existing = set(self._working_tree_files())
+        for path in tracked - existing:
+            del index.entries[(path, 0)]
+        index.add(sorted(existing if include_untracked else existing & tracked), write=False)
+        index.write()
+        return index
+
+    def _commit(self, index, message, allow_empty=False):
+        tree = index.write_tree()
+        head = self._repo.head
+        parent_tree = head.commit.tree.hexsha if head.is_valid() else EMPTY_TREE_SHA
+        if tree.hexsha == parent_tree and not allow_empty:
+            raise git.GitCommandError(['git', 'commit'], 1, stderr='nothing to commit')
+        # Like git, end the message with a newline
+        git.Commit.create_from_tree(self._repo, tree, message + '\n', head=True,
+                                    author=self._author, committer=self._committer,
+                                    author_date=self._author_date, commit_date=self._commit_date)
 
+    def add(self, *paths, **kwargs):
+        if kwargs.get('all'):
+            self._stage(include_untracked=True)
+        else:
+            self._repo.index.add(list(paths))
 
-def pytest_assertrepr_compare(op, left, right):
-    if isinstance(left, ComparableFile) and isinstance(right, ComparableFile) and op == '==':
-        return list(difflib.ndiff(left.lines(), right.lines()))
+    def commit(self, message=None, m=None, allow_empty=False, all=False):
+        index = self._stage(include_untracked=False) if all else self._repo.index
+        self._commit(index, message or m, allow_empty=allow_empty)
+
+    def add_and_commit(self, message):
+        """ Does 'git add --all' and 'git commit' using the same index """
+        self._commit(self._stage(include_untracked=True), message)
+
+
+class _LooseObjectStoreDB(git.GitCmdObjectDB):
+    """ Writes objects with gitdb rather than starting 'git hash-object' for each one """
+    def __init__(self, root_path, git):
+        super(_LooseObjectStoreDB, self).__init__(root_path, git)
+        self._loose_odb = gitdb.LooseObjectDB(root_path)
+
+    def store(self, istream):
+        return self._loose_odb.store(istream)
+
+
+def _open_in_process_repo(path, author, committer, author_date, commit_date):
+    """ Returns the repo at path, with a git attribute that adds and commits in-process
+
+    Dates are in git's internal '<timestamp> <offset>' format.
+    """
+    repo = git.Repo(path, odbt=_LooseObjectStoreDB)
+    repo.git = InProcessGit(repo, author, committer, author_date, commit_date)
+    return repo
+
+
+@pytest.fixture(scope="module")
+def open_in_process_repo():
+    return _open_in_process_repo
@@ -1,6 +1,4 @@
 import os
-import shutil
-import tempfile
 
 import git
 import pytest  # noqa
@@ -9,29 +7,54 @@ from gradon import core
 from gradon import file_system
 
 
-def empty_tree_sha(git_repo):
-    """ Magic SHA for an empty source repo, useful for initial diffs """
-    # http://stackoverflow.com/questions/9765453/is-gits-semi-secret-empty-tree-object-reliable-and-why-is-there-not-a-symbolic  # noqa
-    return git_repo.git.hash_object('/dev/null', t='tree')
+def changed_paths(git_repo, rev):
+    """ Paths that differ between rev and HEAD, without building a diff for each one """
+    return git_repo.git.diff('--name-only', rev, 'HEAD').splitlines()
+
+
+@pytest.fixture(scope='session')
+def _source_template(tmpdir_factory):
+    """ The directories and file contents of an empty repo
+
+    These are written out for each test rather than running 'git init' every time.
+    """
+    template_dir = str(tmpdir_factory.mktemp('source-template'))
+    git.Repo.init(template_dir)
+    dirs = []
+    files = {}
+    for dir_path, _, file_names in os.walk(template_dir):
+        dirs.append(os.path.relpath(dir_path, template_dir))
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, template_dir)] = f.read()
+    return dirs, files
 
 
 @pytest.fixture
-def _source_dir(tmpdir):
-    return str(tmpdir.mkdir('my-source'))
+def _source_dir(tmpdir, _source_template):
+    source_dir = str(tmpdir.join('my-source'))
+    dirs, files = _source_template
+    for dir_path in dirs:  # Parents come first
+        os.mkdir(os.path.normpath(os.path.join(source_dir, dir_path)))
+    for file_path, contents in files.items():
+        fd = os.open(os.path.join(source_dir, file_path), os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, contents)
+        finally:
+            os.close(fd)
+    return source_dir
 
 
 @pytest.fixture
-def source_repo(_source_dir):
-    source_repo = git.Repo.init(_source_dir)
-    source_repo.git.update_environment(
-        GIT_AUTHOR_EMAIL='author@example.com',
-        GIT_AUTHOR_NAME='Ms. Author',
-        GIT_AUTHOR_DATE='2017-02-18 22:00:05-08:00',
-        GIT_COMMITTER_EMAIL='committer@example.com',
-        GIT_COMMITTER_NAME='Mr. Committer',
-        GIT_COMMITTER_DATE='2017-02-19 22:00:05-08:00',
+def source_repo(_source_dir, open_in_process_repo):
+    return open_in_process_repo(
+        _source_dir,
+        author=git.Actor('Ms. Author', 'author@example.com'),
+        committer=git.Actor('Mr. Committer', 'committer@example.com'),
+        author_date='1487484005 -0800',  # 2017-02-18 22:00:05-08:00
+        commit_date='1487570405 -0800',  # 2017-02-19 22:00:05-08:00
     )
-    return source_repo
 
 
 @pytest.fixture
@@ -41,8 +64,16 @@ def source_path(source_repo):
 
 @pytest.fixture
 def write_source_file(source_path):
-    def writer(file_path):
-        return open(os.path.join(source_path, file_path), 'w')
+    def writer(file_path, content=None):
+        """ Writes content to a source file, or returns the open file if there is no content """
+        path = os.path.join(source_path, file_path)
+        if content is None:
+            return open(path, 'w')
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, content.encode('utf-8'))
+        finally:
+            os.close(fd)
     return writer
 
 
@@ -52,104 +83,124 @@ FS_CLASSES = (file_system.GitCachedIndexStatsFileSystem,
               file_system.GitIndexStatsFileSystem)
 
 
-@pytest.fixture(params=FS_CLASSES)
+def pytest_generate_tests(metafunc):
+    # Most tests only use one file system class, unless all of them are asked for
+    if 'dest_fs' in metafunc.fixturenames and metafunc.config.getoption('run_all_fs'):
+        metafunc.parametrize('dest_fs', FS_CLASSES, indirect=True,
+                             ids=[c.__name__ for c in FS_CLASSES])
+
+
+def make_dest_fs(source_dir, fs_class=file_system.GitCachedIndexStatsFileSystem):
+    """ Stats file system inside a source dir, for tests that only need the one class """
+    return fs_class(os.path.join(source_dir, '.gradon'))
+
+
+@pytest.fixture
 def dest_fs(request, _source_dir):
-    dest_path = os.path.join(_source_dir, '.gradon')
-    return request.param(dest_path)
+    return make_dest_fs(_source_dir, getattr(request, 'param',
+                                             file_system.GitCachedIndexStatsFileSystem))
+
+
+@pytest.fixture(params=FS_CLASSES)
+def all_fs_dest_fs(request, _source_dir):
+    return make_dest_fs(_source_dir, request.param)
+
+
+def test_source_repo_commits_like_git(source_repo, write_source_file):
+    """ The in-process git refuses empty commits unless they are allowed, as git does """
+    with pytest.raises(git.GitCommandError):
+        source_repo.git.commit(message='Nothing')
+    source_repo.git.commit(message='Initial commit', allow_empty=True)
+
+    # Like 'git commit -a', untracked files aren't committed
+    write_source_file('file.py', 'def foo(): pass\n')
+    with pytest.raises(git.GitCommandError):
+        source_repo.git.commit(message='Untracked', all=True)
 
+    source_repo.git.add_and_commit('Added')
+    assert source_repo.head.commit.message == 'Added\n'
+    assert source_repo.git.status(porcelain=True) == ''
 
-def test_update_cache(source_repo, dest_fs, write_source_file):
+
+def test_update_cache(source_repo, all_fs_dest_fs, write_source_file, empty_tree_sha):
     """ Creates a copy of the repo with all of the metadata """
     source_repo.git.commit(message='Initial commit', allow_empty=True)
-    with write_source_file('file.py') as file:
-        file.write('def foo(): pass\n')
-    with write_source_file('test_file.py') as file:
-        file.write('def foo(): pass\n')
-    source_repo.git.add(all=True)
-    source_repo.git.commit(message='My message')
-    core.update_stats_fs_from_repo(dest_fs, source_repo)
-    dest_repo = dest_fs.repo
+    write_source_file('file.py', 'def foo(): pass\n')
+    write_source_file('test_file.py', 'def foo(): pass\n')
+    source_repo.git.add_and_commit('My message')
+    core.update_stats_fs_from_repo(all_fs_dest_fs, source_repo)
+    dest_repo = all_fs_dest_fs.repo
+    # Each head.commit resolves HEAD from disk again, so look them up once
+    source_commit = source_repo.head.commit
+    dest_commit = dest_repo.head.commit
 
     # Commit message was copied verbatim from source
-    assert dest_repo.head.commit.message == (
-        '{}\nMy message\n'.format(source_repo.head.commit.hexsha))
-    assert dest_repo.head.commit.author == source_repo.head.commit.author
-    # assert dest_repo.head.commit.authored_datetime == source_repo.head.commit.authored_datetime
-    assert dest_repo.head.commit.committer == source_repo.head.commit.committer
-    # assert dest_repo.head.commit.committed_datetime == source_repo.head.commit.committed_datetime
+    assert dest_commit.message == '{}\nMy message\n'.format(source_commit.hexsha)
+    assert dest_commit.author == source_commit.author
+    # assert dest_commit.authored_datetime == source_commit.authored_datetime
+    assert dest_commit.committer == source_commit.committer
+    # assert dest_commit.committed_datetime == source_commit.committed_datetime
 
     # Stats were generated
-    assert 'TOTAL.stats.yaml' in [
-        d.b_path for d in dest_repo.head.commit.diff(empty_tree_sha(source_repo))]
+    assert 'TOTAL.stats.yaml' in changed_paths(dest_repo, empty_tree_sha)
 
 
-def test_update_cache_with_ignored_files(source_repo, dest_fs, write_source_file):
+def test_update_cache_with_ignored_files(source_repo, dest_fs, write_source_file,
+                                         empty_tree_sha):
     """ Ignores files matching provided patterns """
     source_repo.git.commit(message='Initial commit', allow_empty=True)
-    with write_source_file('file.py') as file:
-        file.write('def foo(): pass\n')
-    with write_source_file('ignored-file.py') as file:
-        file.write('def foo(): pass\n')
-    source_repo.git.add(all=True)
-    source_repo.git.commit(message='My message')
+    write_source_file('file.py', 'def foo(): pass\n')
+    write_source_file('ignored-file.py', 'def foo(): pass\n')
+    source_repo.git.add_and_commit('My message')
 
     core.update_stats_fs_from_repo(dest_fs, source_repo, exclude_patterns=('ignored-file',))
 
-    new_files = [d.b_path for d in dest_fs.repo.head.commit.diff(empty_tree_sha(source_repo))]
+    new_files = changed_paths(dest_fs.repo, empty_tree_sha)
 
     # Stats were generated
     assert 'file.py.stats.yaml' in new_files
     assert 'ignored-file.py.stats.yaml' not in new_files
 
 
-def test_update_cache_with_existing_repo(source_repo, write_source_file):
+def test_update_cache_with_existing_repo(tmpdir, source_repo, write_source_file):
     """ It starts again where we left off """
-    try:
-        dest_dir = tempfile.mkdtemp()
-        git_env = dict(GIT_COMMITTER_EMAIL='noone@example.com', GIT_COMMITTER_NAME='No One',
-                       GIT_AUTHOR_EMAIL='noone@example.com', GIT_AUTHOR_NAME='No One')
-        dest_repo = git.Repo.init(dest_dir)
-        dest_repo.git.update_environment(**git_env)
+    dest_dir = str(tmpdir.mkdir('dest'))
+    git_env = dict(GIT_COMMITTER_EMAIL='noone@example.com', GIT_COMMITTER_NAME='No One',
+                   GIT_AUTHOR_EMAIL='noone@example.com', GIT_AUTHOR_NAME='No One')
+    dest_repo = git.Repo.init(dest_dir)
+    dest_repo.git.update_environment(**git_env)
 
-        # Synchronize source and destination repos
-        source_repo.git.commit(message='Initial commit', allow_empty=True)
-        dest_repo.git.commit(message='{}\nSome message'.format(source_repo.head.commit.hexsha),
-                             allow_empty=True)
+    # Synchronize source and destination repos
+    source_repo.git.commit(message='Initial commit', allow_empty=True)
+    dest_repo.git.commit(message='{}\nSome message'.format(source_repo.head.commit.hexsha),
+                         allow_empty=True)
 
-        # Now add a file to the destination
-        with write_source_file('file.py') as file:
-            file.write('def foo(): pass\n')
-        source_repo.git.add(all=True)
-        source_repo.git.commit(message='My message')
+    # Now add a file to the destination
+    write_source_file('file.py', 'def foo(): pass\n')
+    source_repo.git.add_and_commit('My message')
 
-        dest_fs = file_system.GitCachedIndexStatsFileSystem(dest_dir)
-        core.update_stats_fs_from_repo(dest_fs, source_repo, 'HEAD~1..HEAD')
+    dest_fs = file_system.GitCachedIndexStatsFileSystem(dest_dir)
+    core.update_stats_fs_from_repo(dest_fs, source_repo, 'HEAD~1..HEAD')
 
-        # Prior commit was not clobbered
-        assert 'Some message' in dest_fs.repo.commit('HEAD~1').message
+    # Prior commit was not clobbered
+    assert 'Some message' in dest_fs.repo.commit('HEAD~1').message
 
-        # Stats were generated
-        assert 'TOTAL.stats.yaml' in [d.b_path for d in dest_repo.head.commit.diff('HEAD~1')]
-    finally:
-        shutil.rmtree(dest_dir)
+    # Stats were generated
+    assert 'TOTAL.stats.yaml' in changed_paths(dest_repo, 'HEAD~1')
 
 
 class TestGenerateStatsFSCommits(object):
-    def test_incremental_from_initial(self, source_repo, dest_fs, write_source_file):
+    def test_incremental_from_initial(self, source_repo, all_fs_dest_fs, write_source_file):
         """ In incremental mode, we create extra commits to catch-up on missing files  """
-        with write_source_file('file.py') as file:
-            file.write('def foo(): pass\n')
-        source_repo.git.add(all=True)
-        source_repo.git.commit(message='Initial commit', allow_empty=True, all=True)
-        with write_source_file('test_file.py') as file:
-            file.write('def foo(): pass\n')
-        source_repo.git.add(all=True)
-        source_repo.git.commit(message='My message', all=True)
+        write_source_file('file.py', 'def foo(): pass\n')
+        source_repo.git.add_and_commit('Initial commit')
+        write_source_file('test_file.py', 'def foo(): pass\n')
+        source_repo.git.add_and_commit('My message')
 
         list(core.generate_stats_fs_commits_for_source_commits(
-            dest_fs, source_repo, (c.hexsha for c in source_repo.iter_commits(reverse=True)),
+            all_fs_dest_fs, source_repo, (c.hexsha for c in source_repo.iter_commits(reverse=True)),
             incremental=True))
-        log = dest_fs.repo.git.log(format='%s', name_only=True)
+        log = all_fs_dest_fs.repo.git.log(format='%s', name_only=True)
         assert log == """\
 b1a75c274d6458a54fb39b2071c4a6bc1c0f0b18 My message
 
@@ -175,23 +226,20 @@ file.py.methods.yaml
 file.py.stats.yaml
 [ignore] edbdba25b0177558f52891a8d95df75988e309ae"""
 
-    def test_incremental_partial(self, source_repo, dest_fs, write_source_file):
+    def test_incremental_partial(self, source_repo, all_fs_dest_fs, write_source_file):
         """ It creates an intermediate commit with any files that will change """
 
-        with write_source_file('test_file.py') as file:
-            file.write('def foo(): pass\n')
-        source_repo.git.add(all=True)
-        source_repo.git.commit(message='Initial commit')
+        write_source_file('test_file.py', 'def foo(): pass\n')
+        source_repo.git.add_and_commit('Initial commit')
         source_repo.git.commit(message='Blank commit', allow_empty=True)
-        with write_source_file('test_file.py') as file:
-            file.write('def foo2(): pass\n')
+        write_source_file('test_file.py', 'def foo2(): pass\n')
         source_repo.git.commit(message='My message', all=True)
 
         list(core.generate_stats_fs_commits_for_source_commits(
-            dest_fs, source_repo, (c.hexsha for c in source_repo.iter_commits('HEAD~1..HEAD',
-                                                                              reverse=True)),
+            all_fs_dest_fs, source_repo,
+            (c.hexsha for c in source_repo.iter_commits('HEAD~1..HEAD', reverse=True)),
             incremental=True))
-        log = dest_fs.repo.git.log(format='%s', name_only=True)
+        log = all_fs_dest_fs.repo.git.log(format='%s', name_only=True)
         assert log == """\
 2d0f67270020d5bb55ead2237182f8f64943ad66 My message
 
@@ -210,18 +258,86 @@ test_file.py.methods.yaml
 test_file.py.stats.yaml"""
 
 
-def test_generate_stats_fs_commit_for_diff(source_repo, dest_fs, write_source_file):
+def test_generate_cached_stats_fs_commits(tmpdir, source_repo, source_path, write_source_file):
+    """ Stats commits already generated are reused, and new source commits are added """
+    write_source_file('file.py', 'def foo(): pass\n')
+    source_repo.git.add_and_commit('Initial commit')
+    write_source_file('test_file.py', 'def foo(): pass\n')
+    source_repo.git.add_and_commit('Second commit')
+
+    dest_fs = make_dest_fs(source_path)
+    first = list(core.generate_cached_stats_fs_commits(
+        dest_fs, source_repo, core.generate_shas_for_source_range(source_repo, None, True),
+        reversed=True))
+
+    write_source_file('file.py', 'def foo(): pass\ndef bar(): pass\n')
+    source_repo.git.add_and_commit('Third commit')
+    source_shas = list(core.generate_shas_for_source_range(source_repo, None, True))
+    cached = list(core.generate_cached_stats_fs_commits(dest_fs, source_repo, iter(source_shas),
+                                                        reversed=True))
+    assert cached[1:] == first
+    assert sorted(core.map_stats_fs_commits(dest_fs)) == sorted(source_shas)
+
+    # The new commit has the same stats as when it is generated into an empty stats_fs
+    fresh_fs = file_system.GitCachedIndexStatsFileSystem(str(tmpdir.join('fresh')))
+    fresh = list(core.generate_cached_stats_fs_commits(fresh_fs, source_repo,
+                                                       iter(source_shas[:1]), reversed=True))
+
+    def rows(stats_fs, fs_commits):
+        return sorted((s.filename, sorted(s.delta.to_dict().items()))
+                      for s in core.generate_stats_for_stats_fs_commits(stats_fs, fs_commits))
+
+    assert rows(dest_fs, cached[:1]) == rows(fresh_fs, fresh)
+
+
+def test_generate_cached_stats_fs_commits_for_ranges(tmpdir, source_repo, source_path,
+                                                     write_source_file):
+    """ Cached stats commits don't depend on the ranges or the order they were generated in """
+    write_source_file('file.py', 'def foo(): pass\n')
+    source_repo.git.add_and_commit('Initial commit')
+    source_repo.git.checkout('-b', 'side')
+    write_source_file('side.py', 'def side(x):\n    if x:\n        return x\n')
+    source_repo.git.add_and_commit('Side commit')
+    source_repo.git.checkout('master')
+    write_source_file('file.py', 'def foo(): pass\ndef bar(): pass\n')
+    source_repo.git.add_and_commit('Master commit')
+    source_repo.git.merge('side', no_ff=True, message='Merge commit')
+    write_source_file('test_file.py', 'def test_foo(): pass\n')
+    source_repo.git.add_and_commit('Last commit')
+
+    def rows(stats_fs, fs_commits):
+        return sorted((s.filename, sorted(s.delta.to_dict().items()))
+                      for s in core.generate_stats_for_stats_fs_commits(stats_fs, fs_commits))
+
+    dest_fs = make_dest_fs(source_path)
+    # Overlapping ranges, one oldest first and the other newest first
+    for rev_range, reverse in (('HEAD~1', False), ('side..HEAD', True)):
+        source_shas = core.generate_shas_for_source_range(source_repo, rev_range, reverse)
+        list(core.generate_cached_stats_fs_commits(dest_fs, source_repo, source_shas,
+                                                   reversed=reverse))
+    cached = core.map_stats_fs_commits(dest_fs)
+    source_shas = list(core.generate_shas_for_source_range(source_repo, None))
+    assert sorted(cached) == sorted(source_shas)
+
+    # Each commit has the same stats as when just its first parents are generated, oldest first,
+    # into an empty stats_fs
+    for i, sha in enumerate(source_shas):
+        fresh_fs = file_system.GitCachedIndexStatsFileSystem(str(tmpdir.join('fresh', str(i))))
+        first_parent_shas = source_repo.git.rev_list(sha, first_parent=True, reverse=True).split()
+        fresh = list(core.generate_cached_stats_fs_commits(fresh_fs, source_repo,
+                                                           iter(first_parent_shas)))
+        assert rows(dest_fs, [cached[sha]]) == rows(fresh_fs, fresh[-1:]), sha
+
+
+def test_generate_stats_fs_commit_for_diff(source_repo, source_path, write_source_file):
     """ Generate fs commits for diff """
     source_repo.git.commit(message='Initial commit', allow_empty=True, all=True)
-    with write_source_file('file.py') as file:
-        file.write('def foo(): pass\n')
-    source_repo.git.add(all=True)
-    source_repo.git.commit(message='My message', all=True)
-    with write_source_file('test_file.py') as file:
-        file.write('def foo(): pass\n')
-    source_repo.git.add(all=True)
-    source_repo.git.commit(message='My last message', all=True)
+    write_source_file('file.py', 'def foo(): pass\n')
+    source_repo.git.add_and_commit('My message')
+    write_source_file('test_file.py', 'def foo(): pass\n')
+    source_repo.git.add_and_commit('My last message')
 
+    dest_fs = make_dest_fs(source_path)
     core.generate_stats_fs_commit_for_diff(dest_fs, source_repo, 'HEAD~2', 'HEAD')
     log = dest_fs.repo.git.log(format='%s', name_only=True)
     assert log == """\
@@ -242,18 +358,16 @@ test_file.py.stats.yaml
 [ignore] 0e3b2ccbb150254c5b3a4319c1bafd280f6b27a4"""
 
 
-def test_generate_stats_fs_commit_for_working_tree_plus_commit(source_repo, dest_fs,
+def test_generate_stats_fs_commit_for_working_tree_plus_commit(source_repo, source_path,
                                                                write_source_file):
     """ Generate fs commits for working tree changes plus extra commit """
     source_repo.git.commit(message='Initial commit', allow_empty=True, all=True)
-    with write_source_file('file.py') as file:
-        file.write('def foo(): pass\n')
-    source_repo.git.add(all=True)
-    source_repo.git.commit(message='My message', all=True)
-    with write_source_file('test_file.py') as file:
-        file.write('def foo(): pass\n')
+    write_source_file('file.py', 'def foo(): pass\n')
+    source_repo.git.add_and_commit('My message')
+    write_source_file('test_file.py', 'def foo(): pass\n')
     source_repo.git.add(all=True)
 
+    dest_fs = make_dest_fs(source_path)
     core.generate_stats_fs_commit_for_diff(dest_fs, source_repo, None, None)
     log = dest_fs.repo.git.log(format='%s', name_only=True)
     assert log == """\
@@ -272,17 +386,16 @@ test_file.py.stats.yaml
 [ignore] 0bb85185a126821a2bcb9e172b69f21fcbdedce1"""
 
 
-def test_generate_stats_fs_commit_for_working_tree_diff(source_repo, dest_fs, write_source_file):
+def test_generate_stats_fs_commit_for_working_tree_diff(source_repo, source_path,
+                                                        write_source_file):
     """ Generate fs commits for working tree changes """
     source_repo.git.commit(message='Initial commit', allow_empty=True, all=True)
-    with write_source_file('file.py') as file:
-        file.write('def foo(): pass\n')
-    source_repo.git.add(all=True)
-    source_repo.git.commit(message='My message', all=True)
-    with write_source_file('test_file.py') as file:
-        file.write('def foo(): pass\n')
+    write_source_file('file.py', 'def foo(): pass\n')
+    source_repo.git.add_and_commit('My message')
+    write_source_file('test_file.py', 'def foo(): pass\n')
     source_repo.git.add(all=True)
 
+    dest_fs = make_dest_fs(source_path)
     core.generate_stats_fs_commit_for_diff(dest_fs, source_repo, 'HEAD~1', None)
     log = dest_fs.repo.git.log(format='%s', name_only=True)
     assert log == """\
@@ -301,3 +414,24 @@ file.py.stats.yaml
 test_file.py.methods.yaml
 test_file.py.stats.yaml
 [ignore] 0e3b2ccbb150254c5b3a4319c1bafd280f6b27a4"""
+
+
+def test_count_commits_for_source_range(source_repo, write_source_file):
+    """ The count matches the number of shas generated for the same range """
+    for i in range(3):
+        write_source_file('a.py', 'a = {}\n'.format(i))
+        source_repo.git.add('a.py')
+        source_repo.git.commit(m='commit {}'.format(i))
+
+    for rev_range in (None, 'HEAD~2..HEAD'):
+        assert (core.count_commits_for_source_range(source_repo, rev_range) ==
+                len(list(core.generate_shas_for_source_range(source_repo, rev_range))))
+
+
+def test_sum_line_deltas():
+    line_deltas = [('pkg/a.py', (3, 2, 1), False),
+                   ('pkg/test_a.py', (5, 5, 0), True),
+                   ('other/b.py', (7, 0, 7), False)]
+    assert core._sum_line_deltas(line_deltas, 'pkg') == ((8, 7, 1), (5, 5, 0), (3, 2, 1))
+    assert core._sum_line_deltas(line_deltas, '') == ((15, 7, 8), (5, 5, 0), (10, 2, 8))
+    assert core._sum_line_deltas(line_deltas, 'none') == ((0, 0, 0), (0, 0, 0), (0, 0, 0))
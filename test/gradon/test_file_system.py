@@ -1,3 +1,4 @@
+import git
 import pytest  # noqa
 
 
@@ -12,16 +13,19 @@ GIT_FS_CLASSES = (file_system.GitCachedIndexStatsFileSystem,
 FS_CLASSES = GIT_FS_CLASSES + (file_system.FileSystem,)
 
 
-@pytest.fixture
-def fs_path(tmpdir):
-    return str(tmpdir.mkdir('my-fs-path'))
+@pytest.fixture(scope='class')
+def fs_path(tmpdir_factory, fs_class):
+    # A file system is shared by the tests in a class, so it is only set up once per class
+    return str(tmpdir_factory.mktemp('my-fs-path'))
 
 
-class TestBasic(object):
-    @pytest.fixture(params=FS_CLASSES)
-    def fs(self, request, fs_path):
-        return request.param(fs_path)
+@pytest.fixture(scope='class')
+def fs(fs_class, fs_path):
+    return fs_class(fs_path)
+
 
+@pytest.mark.parametrize('fs_class', FS_CLASSES, scope='class')
+class TestBasic(object):
     def test_path(self, fs_path, fs):
         """ Path returned is the path passed to the constructor """
         assert fs.path == fs_path
@@ -32,12 +36,53 @@ class TestBasic(object):
             f.write('hello')
         assert fs.read('my-dir', 'my-file') == 'hello'
 
+    def test_missing_paths(self, fs):
+        """ Missing files and directories read as empty rather than raising """
+        with fs.add_file('my-file') as f:
+            f.write('hello')
+        assert fs.read('missing') is None
+        assert fs.read('my-file', 'missing') is None
+        assert list(fs.ls_files('missing')) == []
+        fs.rm('missing')
+        fs.rmdir('missing')
 
-class TestGit(object):
-    @pytest.fixture(params=GIT_FS_CLASSES)
-    def fs(self, request, fs_path):
-        return request.param(fs_path)
 
+@pytest.mark.parametrize('fs_class', GIT_FS_CLASSES, scope='class')
+class TestGit(object):
     def test_commit_and_head_message(self, fs):
         fs.commit('my commit message')
         assert fs.head_message.startswith('my commit message')
+
+    def test_stream_blob(self, fs):
+        """ Partially read streams don't disturb later reads """
+        with fs.add_file('my-file') as f:
+            f.write('hello world')
+        fs.commit('my commit message')
+        with fs.stream_blob('HEAD', 'my-file') as stream:
+            assert stream.read(5) == b'hello'
+        assert fs.read_blob('HEAD', 'my-file') == b'hello world'
+
+    def test_commit_identities(self, fs):
+        """ Author and committer apply to the commit without leaking into later ones """
+        actor = git.Actor('Some One', 'someone@example.com')
+        fs.commit('my commit message', author=actor, committer=actor)
+        assert fs.repo.head.commit.author.email == 'someone@example.com'
+        assert fs.repo.head.commit.committer.name == 'Some One'
+
+        fs.commit('another commit message')
+        assert fs.repo.head.commit.author.email != 'someone@example.com'
+
+    def test_deferred_add_file(self, fs):
+        """ Deferred files are committed and readable like any other """
+        with fs.add_file('.', 'my-dir', 'my-file', deferred=True) as f:
+            f.write('hello')
+        assert fs.read('my-dir', 'my-file') == 'hello'
+        fs.commit('my commit message')
+        assert fs.read_blob('HEAD', 'my-dir/my-file') == b'hello'
+
+    def test_deferred_add_file_read_after_commit(self, fs):
+        """ Deferred files that are only committed are still readable afterwards """
+        with fs.add_file('.', 'my-dir', 'my-other-file', deferred=True) as f:
+            f.write('hello')
+        fs.commit('my commit message')
+        assert fs.read('my-dir', 'my-other-file') == 'hello'
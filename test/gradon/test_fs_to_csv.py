@@ -0,0 +1,61 @@
+import csv
+import io
+import os
+
+import git
+import pytest  # noqa
+
+from gradon import core
+from gradon import file_system
+from gradon import fs_to_csv
+
+
+@pytest.fixture
+def stats_fs_commits(tmpdir):
+    """ A stats file system and its stats commits for a few source commits """
+    source_repo = git.Repo.init(str(tmpdir.mkdir('my-source')))
+    source_repo.git.update_environment(
+        GIT_COMMITTER_EMAIL='noone@example.com', GIT_COMMITTER_NAME='No One',
+        GIT_AUTHOR_EMAIL='noone@example.com', GIT_AUTHOR_NAME='No One')
+    source_repo.git.commit(message='Initial commit', allow_empty=True)
+    for i, name in enumerate(('file.py', 'test_file.py', 'file.py')):
+        with open(os.path.join(source_repo.working_tree_dir, name), 'a') as f:
+            f.write('def foo{}(): pass\n'.format(i))
+        source_repo.git.add(name)
+        source_repo.git.commit(message='Commit {}'.format(i))
+
+    stats_fs = file_system.GitCachedIndexStatsFileSystem(str(tmpdir.join('stats')))
+    fs_commits = list(core.generate_stats_fs_commits_for_source_commits(
+        stats_fs, source_repo, core.generate_shas_for_source_range(source_repo, None)))
+    return stats_fs, fs_commits
+
+
+def _to_csv(stats_fs, fs_commits, **kwargs):
+    output = io.StringIO()
+    fs_to_csv.fs_commits_to_csv(stats_fs, fs_commits, csv.writer(output),
+                                test_patterns=(r'^test_',), **kwargs)
+    return output.getvalue()
+
+
+def test_fs_commits_to_csv_in_parallel(stats_fs_commits):
+    """ Worker processes give the same rows as generating the stats in this process """
+    serial = _to_csv(*stats_fs_commits)
+    assert len(serial.splitlines()) > 1
+    assert _to_csv(*stats_fs_commits, parallel=True) == serial
+
+
+def test_fs_commits_to_csv_stops_writing_on_error(stats_fs_commits, monkeypatch):
+    """ The trailing partial batch of rows isn't written after a failure """
+    stats_fs, fs_commits = stats_fs_commits
+
+    def generate_stats(*args, **kwargs):
+        for s in generate_stats_for_stats_fs_commits(*args, **kwargs):
+            yield s
+        raise KeyError('oops')
+
+    generate_stats_for_stats_fs_commits = core.generate_stats_for_stats_fs_commits
+    monkeypatch.setattr(core, 'generate_stats_for_stats_fs_commits', generate_stats)
+    output = io.StringIO()
+    with pytest.raises(KeyError):
+        fs_to_csv.fs_commits_to_csv(stats_fs, fs_commits, csv.writer(output))
+    assert len(output.getvalue().splitlines()) == 1  # Just the header
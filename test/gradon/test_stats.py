@@ -1,13 +1,20 @@
 import os
 
 import pytest  # noqa
+from radon import raw
 
 
 from gradon import stats
 from gradon import file_system
+from gradon import tools
 
 
-TEST_PATTERNS = (r'^tests?_.*.\py$', r'_tests?\.py$')
+TEST_PATTERNS = (r'^tests?_.*\.py$', r'_tests?\.py$')
+
+
+@pytest.fixture(scope='session')
+def compiled_test_patterns():
+    return tools.compile_any(TEST_PATTERNS)
 
 
 @pytest.fixture
@@ -28,7 +35,7 @@ def dest_fs(request, source_dir):
     return request.param(dest_path)
 
 
-def test_update_stats(source_dir, dest_fs, cmpfile):
+def test_update_stats(source_dir, dest_fs, compiled_test_patterns):
     """ Updates all the stats in a path """
     with open(os.path.join(source_dir, 'file.py'), 'w') as file:
         file.write('def foo(): pass\n')
@@ -36,28 +43,37 @@ def test_update_stats(source_dir, dest_fs, cmpfile):
         file.write('def test_foo(): pass\n')
         file.write('def test_foo2(): pass\n')
 
-    stats.StatsUpdater(source_dir, dest_fs, test_patterns=TEST_PATTERNS, debug=True).update()
-    if hasattr(dest_fs, '_sync_working_tree'):
-        dest_fs._sync_working_tree('.')  # We need to commit or the files are not written to disk
-    orig_dir = os.getcwd()
+    stats.StatsUpdater(source_dir, dest_fs, test_patterns=compiled_test_patterns,
+                       debug=True).update()
 
-    dest_path = os.path.join(source_dir, '.gradon')
-    os.chdir(dest_path)
-    try:
-        files = os.listdir('.')
-        assert 'file.py.stats.yaml' in files
-        assert 'test_file.py.stats.yaml' in files
-        assert cmpfile('file.py.stats.yaml') == cmpfile('TOTAL_NON_TEST.stats.yaml')
-        assert cmpfile('test_file.py.stats.yaml') == cmpfile('TOTAL_TEST.stats.yaml')
-        assert cmpfile('TOTAL_NON_TEST.stats.yaml') == cmpfile('SUBTREE_TOTAL_NON_TEST.stats.yaml')
-        assert cmpfile('TOTAL_TEST.stats.yaml') == cmpfile('SUBTREE_TOTAL_TEST.stats.yaml')
-        assert cmpfile('TOTAL.stats.yaml') == cmpfile('SUBTREE_TOTAL.stats.yaml')
-    finally:
-        os.chdir(orig_dir)
-
-
-def test_ignore_patterns(source_dir, dest_fs):
+    # Read through the file system, which knows about files it hasn't written to disk yet
+    files = dest_fs.ls_files('.')
+    assert 'file.py.stats.yaml' in files
+    assert 'test_file.py.stats.yaml' in files
+    assert dest_fs.read('file.py.stats.yaml') == dest_fs.read('TOTAL_NON_TEST.stats.yaml')
+    assert dest_fs.read('test_file.py.stats.yaml') == dest_fs.read('TOTAL_TEST.stats.yaml')
+    assert (dest_fs.read('TOTAL_NON_TEST.stats.yaml') ==
+            dest_fs.read('SUBTREE_TOTAL_NON_TEST.stats.yaml'))
+    assert dest_fs.read('TOTAL_TEST.stats.yaml') == dest_fs.read('SUBTREE_TOTAL_TEST.stats.yaml')
+    assert dest_fs.read('TOTAL.stats.yaml') == dest_fs.read('SUBTREE_TOTAL.stats.yaml')
+
+
+def test_update_stats_with_compiled_flagged_patterns(source_dir, dest_fs):
+    """ Precompiled patterns keep their inline flags """
+    with open(os.path.join(source_dir, 'file.py'), 'w') as file:
+        file.write('def foo(): pass\n')
+    with open(os.path.join(source_dir, 'TEST_file.py'), 'w') as file:
+        file.write('def test_foo(): pass\n')
+
+    test_patterns = tools.compile_any(['(?i)^test_', r'_tests?\.py$'])
+    stats.StatsUpdater(source_dir, dest_fs, test_patterns=test_patterns).update()
+
+    assert dest_fs.read('TEST_file.py.stats.yaml') == dest_fs.read('TOTAL_TEST.stats.yaml')
+
+
+def test_ignore_patterns(source_dir, dest_fs, canonical_analysis, monkeypatch):
     """ Files whose names are in the ignored pattern list are not processed """
+    monkeypatch.setattr(stats, '_analyze_file', lambda path: canonical_analysis)
     with open(os.path.join(source_dir, 'file.py'), 'w') as file:
         file.write('def foo(): pass\n')
     with open(os.path.join(source_dir, 'ignore-file.py'), 'w') as file:
@@ -70,8 +86,9 @@ def test_ignore_patterns(source_dir, dest_fs):
     assert 'ignore-file.py.stats.yaml' not in files
 
 
-def test_ignore_patterns_in_dir(source_dir, dest_fs):
+def test_ignore_patterns_in_dir(source_dir, dest_fs, canonical_analysis, monkeypatch):
     """ Files whose parent directories match the ignored pattern list are not processed """
+    monkeypatch.setattr(stats, '_analyze_file', lambda path: canonical_analysis)
     os.mkdir(os.path.join(source_dir, 'ignore-dir'))
     with open(os.path.join(source_dir, 'file.py'), 'w') as file:
         file.write('def foo(): pass\n')
@@ -84,3 +101,122 @@ def test_ignore_patterns_in_dir(source_dir, dest_fs):
     assert 'file.py.stats.yaml' in files
     subdir_files = os.listdir(os.path.join(source_dir, '.gradon', 'ignore-dir'))
     assert 'ignore-file.py.stats.yaml' not in subdir_files
+
+
+def test_select_files_in_dir(source_dir, dest_fs):
+    """ Files starting with any of the given path prefixes are skipped """
+    for name in ('a.py', 'ab.py', 'b.py', 'c.txt'):
+        with open(os.path.join(source_dir, name), 'w') as file:
+            file.write('')
+    os.mkdir(os.path.join(source_dir, 'sub'))
+
+    updater = stats.StatsUpdater(source_dir, dest_fs)
+    assert sorted(updater._select_files_in_dir('.', paths=('./a',))) == ['b.py']
+    assert sorted(updater._select_files_in_dir('.', paths=('./c',))) == ['a.py', 'ab.py', 'b.py']
+    assert updater._select_files_in_dir('sub', paths=('su',)) == []
+
+
+def test_scandirs_depth_first(tmpdir):
+    """ Subdirectories come before their parents, and hidden directories are skipped """
+    tmpdir.ensure('a', 'b', 'c', dir=True)
+    tmpdir.ensure('a', '.hidden', 'd', dir=True)
+    tmpdir.ensure('a', 'file.py')
+
+    assert list(stats.scandirs_depth_first(str(tmpdir))) == [
+        os.path.join('a', 'b', 'c'), os.path.join('a', 'b'), 'a']
+
+
+def test_analysis_cache(source_dir, monkeypatch):
+    """ Files whose contents haven't changed are not analyzed again """
+    with open(os.path.join(source_dir, 'file.py'), 'w') as file:
+        file.write('def foo(): pass\n')
+
+    analyzed = []
+    analyze_file = stats._analyze_file
+    monkeypatch.setattr(stats, '_analyze_file', lambda path: analyzed.append(path) or
+                        analyze_file(path))
+
+    updater = stats.StatsUpdater(source_dir, file_system.FileSystem(
+        os.path.join(source_dir, '.gradon')))
+    updater.update()
+    updater.update()
+    assert len(analyzed) == 1
+
+    with open(os.path.join(source_dir, 'file.py'), 'w') as file:
+        file.write('def bar(): pass\n')
+    updater.update()
+    assert len(analyzed) == 2
+
+
+def test_unchanged_subtrees_not_stored(source_dir, dest_fs, monkeypatch):
+    """ Subtree totals that haven't changed aren't rewritten or propagated to the parents """
+    os.makedirs(os.path.join(source_dir, 'a', 'b'))
+    with open(os.path.join(source_dir, 'a', 'b', 'file.py'), 'w') as file:
+        file.write('def foo(): pass\n')
+
+    updater = stats.StatsUpdater(source_dir, dest_fs)
+    updater.update()
+
+    stored = []
+    store_stats = updater._store_stats
+    monkeypatch.setattr(updater, '_store_stats', lambda series, *path: stored.append(path) or
+                        store_stats(series, *path))
+    aggregated = []
+    aggregate_subtree = updater._aggregate_subtree
+    monkeypatch.setattr(updater, '_aggregate_subtree', lambda path: aggregated.append(path) or
+                        aggregate_subtree(path))
+
+    updater.update([os.path.join('a', 'b', 'file.py')])
+    assert not [path for path in stored if path[-1].startswith('SUBTREE_')]
+    assert aggregated == [os.path.join('a', 'b')]
+
+    with open(os.path.join(source_dir, 'a', 'b', 'file.py'), 'w') as file:
+        file.write('def foo(): pass\ndef bar(): pass\n')
+    updater.update([os.path.join('a', 'b', 'file.py')])
+    assert aggregated[1:] == [os.path.join('a', 'b'), 'a', '.']
+    assert updater._load_stats('SUBTREE_TOTAL')[('stats', 'loc')] == 2
+
+
+@pytest.mark.parametrize('code', [
+    'x = """\nsome\ntext\n"""\ny = 1\n',
+    'foo(a,\n    b)  # comment\nif x: return 0\n',
+    'x = 1 + \\\n    2\n',
+    'x = (1,\n',
+])
+@pytest.mark.parametrize('lazy_tokenizer', [True, False])
+def test_analyze_raw(code, lazy_tokenizer, monkeypatch):
+    """ Multi-line statements are counted as radon counts them """
+    def analyze(analyze_raw):
+        try:
+            return analyze_raw(code)
+        except SyntaxError as e:
+            return str(e)
+
+    monkeypatch.setattr(stats, '_LAZY_TOKENIZER', lazy_tokenizer and stats._LAZY_TOKENIZER)
+    assert analyze(stats._analyze_raw) == analyze(raw.analyze)
+
+
+@pytest.mark.parametrize('code', [
+    'def foo():\n    x = 1; y = 2\n    if x: return y  # comment\n',
+    'def foo():\n    """ docs """\n    return (1,\n            2)\n',
+    'def foo():\n    # only a comment\n    pass;\n',
+    'def foo():\n    x = """a"""\n    return x\n',
+    'def foo():\n    return (1,\n',
+])
+def test_block_lloc(code):
+    """ Blocks have the logical line count radon gives them, or fail the same way """
+    def count(block_lloc):
+        try:
+            return block_lloc(code)
+        except Exception as e:
+            return type(e)
+
+    expected = count(lambda code: raw.analyze(code).lloc)
+    assert count(lambda code: stats._analyze_raw(code).lloc) == expected
+    assert count(stats._block_lloc) == expected
+
+    line_tokens = {}
+    line_lloc = {}
+    assert count(lambda code: stats._block_lloc(code, line_tokens, line_lloc)) == expected
+    # Again, from the kept line counts
+    assert count(lambda code: stats._block_lloc(code, line_tokens, line_lloc)) == expected
@@ -1,5 +1,4 @@
 import pandas as pd
-from pandas.util import testing as pdt
 
 import pytest  # noqa
 
@@ -19,8 +18,38 @@ def adapter(dest_fs):
 
 
 def test_get_and_set(adapter):
+    from pandas.util import testing as pdt
+
     series = pd.Series({('a', 'x'): 1,
                         ('a', 'y'): 2,
                         ('b', 'z'): 3})
     adapter.set('my-dir/my-series', series)
     pdt.assert_series_equal(adapter.get('my-dir/my-series'), series)
+
+
+def test_rm_normalizes_path(tmpdir):
+    adapter = stats_fs_adapter.CachedStatsFSAdapter(file_system.FileSystem(str(tmpdir)))
+    adapter.set('TOTAL', pd.Series({('a', 'x'): 1}))
+    adapter.rm('./TOTAL')
+    assert adapter.get('TOTAL') is None
+
+
+def test_cache_size(tmpdir, monkeypatch):
+    monkeypatch.setattr(stats_fs_adapter, 'STATS_CACHE_SIZE', 2)
+    adapter = stats_fs_adapter.CachedStatsFSAdapter(file_system.FileSystem(str(tmpdir)))
+    for name in ('a', 'b', 'c'):
+        adapter.set(name, pd.Series({('a', 'x'): 1}))
+    assert list(adapter._cache) == ['b', 'c']
+    assert adapter.get('a')[('a', 'x')] == 1
+
+
+def test_set_unchanged(tmpdir):
+    """ Setting the stats a path already has doesn't write them again """
+    fs = file_system.FileSystem(str(tmpdir))
+    adapter = stats_fs_adapter.CachedStatsFSAdapter(fs)
+    adapter.set('TOTAL', pd.Series({('a', 'x'): 1}))
+    tmpdir.join('TOTAL.stats.yaml').remove()
+    adapter.set('TOTAL', pd.Series({('a', 'x'): 1}))
+    assert not tmpdir.join('TOTAL.stats.yaml').exists()
+    adapter.set('TOTAL', pd.Series({('a', 'x'): 2}))
+    assert tmpdir.join('TOTAL.stats.yaml').exists()
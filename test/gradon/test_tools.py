@@ -0,0 +1,143 @@
+import io
+import itertools
+import os
+import re
+
+import git
+import pytest  # noqa
+import yaml
+
+from gradon import tools
+
+
+@pytest.fixture
+def repo(tmpdir):
+    return git.Repo.init(str(tmpdir.mkdir('my-repo')))
+
+
+def commit_files(repo, message, **files):
+    for name, contents in files.items():
+        with open(os.path.join(repo.working_tree_dir, name), 'w') as f:
+            f.write(contents)
+    repo.index.add(list(files))
+    return repo.index.commit(message).hexsha
+
+
+def test_generate_tree_changes(repo):
+    """ Adds, deletes and modifications are reported with their paths and blobs """
+    first = commit_files(repo, 'first', changed='a\n', removed='b\n')
+    repo.index.remove(['removed'], working_tree=True)
+    second = commit_files(repo, 'second', changed='c\n', added='d\n')
+
+    changes = sorted(tools.generate_tree_changes(repo, first, second), key=lambda c: c.status)
+
+    assert [(c.status, c.a_path, c.b_path) for c in changes] == [
+        ('A', None, 'added'),
+        ('D', 'removed', None),
+        ('M', 'changed', 'changed')]
+    assert changes[0].a_blob is None
+    assert changes[1].b_blob is None
+    assert changes[2].a_blob != changes[2].b_blob
+
+
+def test_generate_tree_changes_with_renames(repo):
+    """ Renames are paired up when requested """
+    first = commit_files(repo, 'first', old='some contents\n')
+    repo.index.move(['old', 'new'])
+    second = repo.index.commit('second').hexsha
+
+    changes = list(tools.generate_tree_changes(repo, first, second, find_renames=True))
+
+    assert [(c.status, c.a_path, c.b_path) for c in changes] == [('R', 'old', 'new')]
+
+
+def test_load_commit(repo):
+    sha = repo.index.commit('first').hexsha
+    assert tools.load_commit(repo, sha) == repo.commit(sha)
+    assert tools.load_commit(repo, sha).message == 'first'
+    assert tools.load_commit(repo, 'HEAD') == repo.commit(sha)
+
+
+def test_compile_any():
+    regex = tools.compile_any(['^test_', re.compile(r'_tests?\.py$')])
+    assert regex.search('test_foo.py')
+    assert regex.search('foo_tests.py')
+    assert not regex.search('foo.py')
+    assert not tools.compile_any([]).search('foo.py')
+    assert tools.compile_any(regex) is regex
+
+
+def test_compile_any_keeps_patterns_apart():
+    """ Flags and groups of each pattern still apply """
+    regex = tools.compile_any([re.compile('(?i)^test_'), re.compile(r'_tests?\.py$')])
+    assert regex.search('TEST_foo.py')
+    assert regex.search('foo_test.py')
+
+    regex = tools.compile_any([r'^(t)\1', r'^(x)\1'])
+    assert regex.search('tt')
+    assert regex.search('xx').group(0) == 'xx'
+
+    assert tools.compile_any([re.compile('foo', re.I)]).search('FOO')
+
+
+def test_load_methods():
+    """ Methods written as JSON or as the older YAML format load the same """
+    methods = [{'foo': {'A': 6}}, {'Bar.baz': {'B': 18}}]
+    stream = io.StringIO()
+    tools.dump_methods(methods, stream)
+
+    assert tools.load_methods(stream.getvalue()) == methods
+    assert tools.load_methods(stream.getvalue().encode('utf-8')) == methods
+    assert tools.load_methods(yaml.safe_dump(methods)) == methods
+
+
+def test_prefetch():
+    """ Items come through in order, after being prepared in the background """
+    prepared = []
+    assert list(tools.prefetch(iter(range(100)), size=4, prepare=prepared.append)) == \
+        list(range(100))
+    assert prepared == list(range(100))
+
+
+def test_prefetch_reraises():
+    def generate():
+        yield 1
+        raise KeyError('oops')
+
+    items = tools.prefetch(generate())
+    assert next(items) == 1
+    with pytest.raises(KeyError):
+        next(items)
+
+
+def test_prefetch_close_stops_producer():
+    closed = []
+
+    def generate():
+        try:
+            for i in itertools.count():
+                yield i
+        finally:
+            closed.append(True)
+
+    items = tools.prefetch(generate(), size=2)
+    assert next(items) == 0
+    items.close()
+    assert closed == [True]
+
+
+def test_tee_count():
+    count, items = tools.tee_count(x for x in 'abc')
+    assert count == 3
+    assert list(items) == ['a', 'b', 'c']
+
+
+def test_load_stats():
+    """ Stats written as JSON or as the older YAML format load the same """
+    stats = {'raw': {'loc': 10, 'lloc': 8}, 'grades': {'A': 2}, 'halstead': {'volume': 1.5}}
+    stream = io.StringIO()
+    tools.dump_stats(stats, stream)
+
+    assert tools.load_stats(stream.getvalue()) == stats
+    assert tools.load_stats(io.BytesIO(stream.getvalue().encode('utf-8'))) == stats
+    assert tools.load_stats(yaml.safe_dump(stats)) == stats